@@ -1,16 +1,34 @@
+import contextlib
 import datetime
+import functools
 import os
 import time
 import dotenv
 import telebot
 import redis
-import json
 import threading
-import sqlite3
+import atexit
+import signal
+import sys
 
 from core.core import Core
 from core.cleaner import clean
 from core.command_parser import CommandParser
+from core.ingest import MessageBuffer
+from core.schema import migrate
+from core.core_cache import CoreCache
+from core.summary_cache import get_summary_cache
+from core.runtime import run_async
+from core.webhook import run_webhook
+from bookkeeping.catalog import get_catalog, tier_name, tier_label, TIER_NAMES
+from core.delivery import DeliveryQueue, SUMMARIES, NOTIFICATIONS
+from core.outbound import OutboundDispatcher
+from core.digest import NotificationDigest, SUMMARY
+from core.priority import queue_stats, QUEUES
+from core import metrics
+from core import log as logging_control
+from core.log import get_logger
+from core.streaming import SummaryStream, StreamRelay, DELIVERED
 from bookkeeping.core import BKCore
 from bookkeeping.deductor import deductor_d
 
@@ -19,8 +37,11 @@ TOKEN = os.getenv('BOT_TOKEN')
 BOT_USERNAME = os.getenv('BOTUSERNAME')
 NOTIFIEE_ID = os.getenv('NOTIFIEE_ID')
 DEBUG = os.getenv('DEBUG') == 'True'
+RUNTIME = os.getenv('BOT_RUNTIME', 'polling')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
 
-SLEEP_TIME = 1
+POP_TIMEOUT = 5
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 2))
 
 if not TOKEN:
     quit("Token parsing failed")
@@ -35,44 +56,80 @@ try:
 except ValueError:
     quit("NOTIFIEE_ID must be a valid integer")
 
+if RUNTIME == 'webhook' and not WEBHOOK_SECRET:
+    quit("WEBHOOK_SECRET is required in webhook mode")
+
+log = get_logger('bot')
+
 bot = telebot.TeleBot(TOKEN, threaded=False)
+redis_conn = redis.Redis(host=os.getenv('REDIS_HOST'))
+outbound = OutboundDispatcher(bot)
 
-cores = {}
+cores = CoreCache(lambda gid: Core(gid, ingest=ingest))
 command_parser = CommandParser(bot_username=BOT_USERNAME, debug=DEBUG)
 bkcore = BKCore()
+ingest = MessageBuffer()
 
 
 def _do_startup():
+    # Bring the database schema up to date; raises if a hot query lost its index
+    migrate()
+    log.info("Database schema up to date")
+
     # Send startup notification
     _send_notification("Bot started successfully")
 
     bkcore.update_group_intervals()
-    print("Ensured up to date intervals")
+    log.info("Ensured up to date intervals")
 
 
 def _send_notification(message):
     """Send notification to the configured notifiee if enabled"""
     if NOTIFIEE_ID != 0:
         try:
-            bot.send_message(NOTIFIEE_ID, f"🔔 {message}")
+            outbound.send(NOTIFIEE_ID, bot.send_message, NOTIFIEE_ID, f"🔔 {message}")
         except Exception as e:
-            print(f"[BOT] Failed to send notification: {e}")
+            log.error("Failed to send notification", error=e)
+
+
+# Routine admin events are batched; digest.critical is for ones that must go out now
+digest = NotificationDigest(_send_notification)
 
 
 def _get_core(gid) -> Core:
-    if gid in cores:
-        return cores[gid]
+    return cores.get(gid)
 
-    else:
-        core = Core(gid)
-        cores[gid] = core
 
-        return core
+def _is_admin(m: telebot.types.Message):
+    return NOTIFIEE_ID != 0 and m.from_user.id == NOTIFIEE_ID
+
+
+@contextlib.contextmanager
+def _measured(handler):
+    """Record a handler's latency and errors under the `handler` label"""
+    try:
+        with metrics.HANDLER_SECONDS.time(handler=handler):
+            yield
+    except Exception:
+        metrics.HANDLER_ERRORS.inc(handler=handler)
+        raise
+
+
+def _measured_handler(handler):
+    """Decorator form of _measured for handlers with a fixed label"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _measured(handler):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
 
 
 @bot.message_handler(commands=['start'])
+@_measured_handler('start')
 def start_message(m: telebot.types.Message):
-    print(f"[BOT] Start/help command from user {m.from_user.id} in chat {m.chat.id}")
+    log.info("Start/help command", chat=m.chat.id, user=m.from_user.id)
     bot.reply_to(m, "👋 Welcome to SummaryBot!\n\nI help you generate concise summaries of your chat conversations. Use /help to see all available commands.")
 
 
@@ -80,9 +137,18 @@ def start_message(m: telebot.types.Message):
 def handle_message(m: telebot.types.Message):
     # Parse command
     result = command_parser.parse(m.text)
-    
+
+    handler = 'message'
     if result.is_command:
-        print(f"[BOT] Handling command-type message")
+        handler = result.command if result.is_valid else 'invalid'
+
+    with _measured(handler):
+        _route_message(m, result)
+
+
+def _route_message(m: telebot.types.Message, result):
+    if result.is_command:
+        log.info("Handling command", chat=m.chat.id, user=m.from_user.id, command=result.command)
         if not result.is_valid:
             bot.reply_to(m, f"❌ {result.error}")
             return
@@ -100,6 +166,12 @@ def handle_message(m: telebot.types.Message):
             change_tier(m)
         elif result.command == 'pay':
             initiate_payment(m)
+        elif result.command == 'stats':
+            show_stats(m)
+        elif result.command == 'reload':
+            reload_prices(m)
+        elif result.command == 'loglevel':
+            set_log_level(m, result.params)
         else:
             bot.reply_to(m, "❓ Unknown command. Use /help to see all available commands.")
         
@@ -108,26 +180,29 @@ def handle_message(m: telebot.types.Message):
     # Handle regular message
     gid = m.chat.id
     core = _get_core(gid)
-    print(f"[BOT] Message from user {m.from_user.id} in chat {gid}: {m.text[:50]}...")
+    log.sampled("Message received", chat=gid, user=m.from_user.id, chars=len(m.text))
 
-    core.new_message(m.id, m.from_user.id, int(time.time()), m.text, " ".join([x for x in [m.from_user.first_name, m.from_user.last_name] if x is not None]))
+    reply = m.reply_to_message.message_id if m.reply_to_message else 0
+    core.new_message(m.id, m.from_user.id, int(time.time()), m.text, " ".join([x for x in [m.from_user.first_name, m.from_user.last_name] if x is not None]), reply)
 
 
 def summary(m: telebot.types.Message):
     gid = m.chat.id
     core = _get_core(gid)
-    print(f"[BOT] Summary request from user {m.from_user.id} in chat {gid}")
+    log.info("Summary request", chat=gid, user=m.from_user.id)
 
     interval = None
 
-    status = core.summ(m.from_user.id, interval=interval)
+    ticket = core.summ(m.from_user.id, interval=interval)
 
-    if status:
-        print(f"[BOT] Summary request accepted for chat {gid}")
+    if ticket:
+        log.info("Summary request accepted", chat=gid, job=ticket.job_id, cached=ticket.cached, attached=ticket.attached)
         bot.set_message_reaction(m.chat.id, m.id, [telebot.types.ReactionTypeEmoji('⚡')])
+        if ticket.stream is not None:
+            StreamRelay(outbound, ticket.stream, gid, reply_to_message_id=m.id, edit_interval=STREAM_EDIT_INTERVAL).start()
         return
 
-    print(f"[BOT] Summary request rejected for chat {gid}")
+    log.info("Summary request rejected", chat=gid, user=m.from_user.id)
     
     # Calculate next available time
     next_available = core.last + core.interval
@@ -178,11 +253,13 @@ def initiate_payment(m: telebot.types.Message):
 
 
 @bot.pre_checkout_query_handler(func=lambda q: True)
+@_measured_handler('pre_checkout')
 def checkout(pre_q: telebot.types.PreCheckoutQuery):
     bot.answer_pre_checkout_query(pre_q.id, ok=True)
 
 
 @bot.message_handler(content_types=['successful_payment'])
+@_measured_handler('successful_payment')
 def got_payment(msg):
     sp = msg.successful_payment
     payload = sp.invoice_payload
@@ -199,35 +276,12 @@ def got_payment(msg):
     if stars_paid == 1 and DEBUG:
         stars_paid = 100
     bkcore.group_payed(gid, stars_paid)
+    digest.critical(f"Payment of {stars_paid} stars for chat (ID: {gid})")
 
 
 def _get_tier_prices():
-    """Get tier pricing from database"""
-    dotenv.load_dotenv()
-    path = os.getenv('SQL_PATH')
-    conn = sqlite3.connect(path)
-    cursor = conn.cursor()
-    
-    # Get pricing data: id, price, interval
-    prices = cursor.execute("SELECT id, price, interval FROM prices ORDER BY id").fetchall()
-    conn.close()
-    
-    tier_info = []
-    tier_names = ["🆓 FREE", "🥉 BASIC", "🥈 PLUS", "🥇 PRO", "💎 MAX", "👑 ELITE"]
-    
-    for tier_id, price, interval_minutes in prices:
-        if tier_id < len(tier_names):
-            name = tier_names[tier_id]
-            if interval_minutes >= 1440:  # >= 24 hours
-                cooldown = f"{interval_minutes // 1440} day{'s' if interval_minutes // 1440 > 1 else ''}"
-            elif interval_minutes >= 60:  # >= 1 hour
-                cooldown = f"{interval_minutes // 60} hr{'s' if interval_minutes // 60 > 1 else ''}"
-            else:
-                cooldown = f"{interval_minutes} min"
-            
-            tier_info.append(f"{name} - {price} stars - {cooldown} cooldown")
-    
-    return tier_info
+    """Get tier pricing from the price catalog"""
+    return [f"{tier.label} - {tier.price} stars - {tier.cooldown} cooldown" for tier in get_catalog().tiers() if tier.id < len(TIER_NAMES)]
 
 
 def show_help(m: telebot.types.Message):
@@ -235,7 +289,7 @@ def show_help(m: telebot.types.Message):
         tier_info = _get_tier_prices()
         tiers_text = "\n".join(tier_info)
     except Exception as e:
-        print(f"[BOT] Error fetching pricing: {e}")
+        log.error("Error fetching pricing", error=e)
         # Fallback to static pricing
         tiers_text = "🆓 FREE - 0 stars - 24 hrs cooldown\n🥉 BASIC - 250 stars - 3 hrs cooldown\n🥈 PLUS - 500 stars - 1 hr cooldown\n🥇 PRO - 1000 stars - 15 min cooldown\n💎 MAX - 2000 stars - 15 min cooldown\n👑 ELITE - 2000 stars - 15 min cooldown"
     
@@ -262,12 +316,11 @@ def change_tier(m: telebot.types.Message):
     status = bkcore.handle_group_update(tier, gid)
 
     if not status:
-        tier_names = ["FREE", "BASIC", "PLUS", "PRO", "MAX", "ELITE"]
-        tier_name = tier_names[tier] if tier < len(tier_names) else f"TIER {tier}"
-        bot.reply_to(m, f"ℹ️ You're already on {tier_name} tier.")
+        bot.reply_to(m, f"ℹ️ You're already on {tier_name(tier)} tier.")
         return
 
     this_core.update()
+    digest.critical(f"Chat (ID: {gid}) switched to the {tier_name(tier)} tier")
     bot.reply_to(m, "✅ Tier updated successfully!")
 
 
@@ -277,9 +330,7 @@ def show_status(m: telebot.types.Message):
     interval, balance, payed_date, active, tier = core.get_status()
 
     status_icon = "🟢" if active else "🔴"
-    tier_names = ["🆓 FREE", "🥉 BASIC", "🥈 PLUS", "🥇 PRO", "💎 MAX", "👑 ELITE"]
-    tier_name = tier_names[tier] if tier < len(tier_names) else f"TIER {tier}"
-    out = f"📊 Account Status\n\n{status_icon} Status: {'Active' if active else 'Inactive'}\n⭐ Balance: {balance} stars\n💎 Tier: {tier_name}\n⏱️ Cooldown: {int(interval / 60)} minutes\n📅 Last Payment: {datetime.datetime.fromtimestamp(payed_date).strftime('%d/%m/%y %H:%M')}"
+    out = f"📊 Account Status\n\n{status_icon} Status: {'Active' if active else 'Inactive'}\n⭐ Balance: {balance} stars\n💎 Tier: {tier_label(tier)}\n⏱️ Cooldown: {int(interval / 60)} minutes\n📅 Last Payment: {datetime.datetime.fromtimestamp(payed_date).strftime('%d/%m/%y %H:%M')}"
 
     bot.reply_to(m, out)
 
@@ -287,107 +338,180 @@ def show_status(m: telebot.types.Message):
 def show(m: telebot.types.Message):
     gid = m.chat.id
     core = _get_core(gid)
-    print(f"[BOT] Show summary request from user {m.from_user.id} in chat {gid}")
+    log.info("Show summary request", chat=gid, user=m.from_user.id)
 
     old_summary = core.get_summary()
     bot.reply_to(m, old_summary)
 
 
+def show_stats(m: telebot.types.Message):
+    if not _is_admin(m):
+        bot.reply_to(m, "❌ This command is only available to the bot administrator.")
+        return
+
+    core_stats = cores.stats()
+    lookups = core_stats['hits'] + core_stats['misses']
+    hit_rate = core_stats['hits'] / lookups * 100 if lookups else 0
+
+    summary_stats = get_summary_cache().stats()
+    summary_lookups = summary_stats['hits'] + summary_stats['misses']
+    summary_hit_rate = summary_stats['hits'] / summary_lookups * 100 if summary_lookups else 0
+
+    out = f"📈 Bot Stats\n\n🧠 Core cache: {core_stats['size']}/{cores.max_size} chats\n✅ Hits: {core_stats['hits']} ({hit_rate:.1f}%)\n❌ Misses: {core_stats['misses']}\n🧹 Evictions: {core_stats['evictions']}\n\n📄 Summary cache: {summary_stats['size']} summaries\n✅ Hits: {summary_stats['hits']} ({summary_hit_rate:.1f}%)\n❌ Misses: {summary_stats['misses']}"
+
+    try:
+        out += "\n\n📬 Summary queues"
+        for name, stats in queue_stats(redis_conn).items():
+            out += f"\n{name}: {stats['depth']} queued, oldest {stats['oldest_wait']:.0f}s, avg wait {stats['avg_wait']:.1f}s over {stats['started']} jobs"
+    except redis.RedisError as e:
+        log.warning("Failed to read queue stats", error=e)
+
+    bot.reply_to(m, out)
+
+
+def reload_prices(m: telebot.types.Message):
+    if not _is_admin(m):
+        bot.reply_to(m, "❌ This command is only available to the bot administrator.")
+        return
+
+    get_catalog().reload()
+    bkcore.update_group_intervals()
+    # Cached cores hold the old intervals and would write them back
+    cores.close()
+    bot.reply_to(m, f"✅ Prices reloaded ({len(get_catalog().tiers())} tiers).")
+
+
+def set_log_level(m: telebot.types.Message, params):
+    if not _is_admin(m):
+        bot.reply_to(m, "❌ This command is only available to the bot administrator.")
+        return
+
+    parts = params.split()
+    logging_control.set_level(parts[0])
+    if len(parts) == 2:
+        logging_control.set_sample_rate(float(parts[1]))
+    bot.reply_to(m, f"✅ Log level set to {logging_control.get_level()}.")
+
+
 def cleaner():
     while True:
-        print("[BOT] Running database cleanup...")
+        log.info("Running database cleanup")
         clean()
+        evicted = cores.sweep()
+        log.info("Evicted idle cores", evicted=evicted, **cores.stats())
         time.sleep(3600)
 
 
-def poll_redis_queues():
-    redis_conn = redis.Redis(host=os.getenv('REDIS_HOST'))
+def _deliver_summary(payload):
+    """Send a summary; the consumer retries it if this raises"""
+    gid = payload['gid']
+    new_summary = payload['summary']
+
+    log.info("Sending summary", chat=gid)
+    stream_key = payload.get('stream_key')
+    if stream_key:
+        stream = SummaryStream(stream_key, redis_conn)
+        # DELIVERED, claimed now or by an earlier attempt of this entry, means a fresh message
+        claimed = DELIVERED if stream.claim_message(DELIVERED) else stream.claimed_message()
+        if claimed not in (None, DELIVERED):
+            # A relay is showing the stream; replace its placeholder with the final text
+            try:
+                outbound.send(gid, bot.edit_message_text, f"{new_summary}", gid, int(claimed))
+                return
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    raise
+                if 'message is not modified' in e.description:
+                    return
+                log.warning("Failed to replace the placeholder, sending a new message", chat=gid, error=e)
+
+    outbound.send(gid, bot.send_message, gid, f"{new_summary}")
+
+
+def _summary_delivered(payload):
+    """Bookkeeping once a summary is sent and acknowledged, kept apart so its failures never resend it"""
+    gid = payload['gid']
+    new_summary = payload['summary']
+
+    # Count the delivery in the admin digest with chat info
+    try:
+        chat_title = outbound.chat_title(gid)
+        digest.add(SUMMARY, f"Summary delivered to '{chat_title}' (ID: {gid})", gid, chat_title)
+    except Exception as e:
+        log.warning("Failed to get chat info", chat=gid, error=e)
+        digest.add(SUMMARY, f"Summary delivered to chat (ID: {gid})", gid)
 
-    while 1:
-        # Check for pending summaries
-        pending_summaries = redis_conn.get('pending')
-        if pending_summaries is None:
-            redis_conn.set('pending', 0)
-            pending_summaries = 0
-        else:
-            pending_summaries = int(pending_summaries)
+    if payload.get('fingerprint'):
+        get_summary_cache().put(payload['fingerprint'], new_summary)
+    if payload.get('requested_at'):
+        metrics.SUMMARY_TURNAROUND_SECONDS.observe(time.time() - payload['requested_at'])
+    if payload.get('inflight'):
+        # Requests for this window are answered from the summary cache from now on
+        redis_conn.delete(payload['inflight'])
 
-        # Check for pending notifications
-        pending_notifications = redis_conn.get('pending_notifications')
-        if pending_notifications is None:
-            redis_conn.set('pending_notifications', 0)
-            pending_notifications = 0
-        else:
-            pending_notifications = int(pending_notifications)
-
-        # If nothing pending, sleep
-        if pending_summaries == 0 and pending_notifications == 0:
-            time.sleep(SLEEP_TIME)
-            continue
-
-        # Process summaries
-        if pending_summaries > 0:
-            redis_conn.incrby('pending', -1)
-            summs_bytes = redis_conn.get('summaries')
-            
-            if summs_bytes is not None:
-                summs = json.loads(summs_bytes.decode('utf-8'))
-                if summs:
-                    new_summary, gid = summs.pop(0)
-                    redis_conn.set('summaries', json.dumps(summs))
-
-                    print(f"[BOT] Sending summary to chat {gid}")
-                    bot.send_message(gid, f"{new_summary}")
-
-                    # Send notification about summary delivery with chat info
-                    try:
-                        chat_info = bot.get_chat(gid)
-                        chat_title = chat_info.title or chat_info.first_name or f"Chat {gid}"
-                        _send_notification(f"Summary delivered to '{chat_title}' (ID: {gid})")
-                    except Exception as e:
-                        print(f"[BOT] Failed to get chat info: {e}")
-                        _send_notification(f"Summary delivered to chat (ID: {gid})")
-
-                    print(f"[BOT] Storing summary {new_summary[:10]} in group {gid}")
-                    core = Core(gid)
-                    core.update_summary(new_summary)
-                    core.close()
-
-        # Process notifications
-        if pending_notifications > 0:
-            redis_conn.incrby('pending_notifications', -1)
-            notifications_bytes = redis_conn.get('notifications')
-            
-            if notifications_bytes is not None:
-                notifications = json.loads(notifications_bytes.decode('utf-8'))
-                if notifications:
-                    notification_message, recipient_id = notifications.pop(0)
-                    redis_conn.set('notifications', json.dumps(notifications))
-
-                    print(f"[BOT] Sending notification to user {recipient_id}")
-                    try:
-                        bot.send_message(recipient_id, f"🔔 {notification_message}")
-                    except Exception as e:
-                        print(f"[BOT] Failed to send notification: {e}")
+    log.debug("Storing summary", chat=gid, chars=len(new_summary))
+    _get_core(gid).update_summary(new_summary)
+
+
+def _delivery_dropped(payload):
+    """A delivery ran out of attempts; the admin hears about it now, not in the next digest"""
+    if 'gid' in payload:
+        digest.critical(f"Dropped a summary for chat (ID: {payload['gid']}) after repeated delivery failures")
+    else:
+        digest.critical(f"Dropped a notification for user (ID: {payload.get('recipient')}) after repeated delivery failures")
+
+
+def _deliver_notification(payload):
+    recipient_id = payload['recipient']
+
+    if recipient_id == NOTIFIEE_ID and payload.get('kind') and not payload.get('critical'):
+        digest.add(payload['kind'], payload['text'], payload.get('chat_id'))
+        return
+
+    log.info("Sending notification", user=recipient_id)
+    outbound.send(recipient_id, bot.send_message, recipient_id, f"🔔 {payload['text']}")
 
 
 if __name__ == '__main__':
-    print("[BOT] Starting Telegram bot...")
+    log.info("Starting Telegram bot")
+
+    # Flush buffered messages on shutdown, including `docker stop`
+    atexit.register(ingest.close)
+    atexit.register(digest.close)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
     _do_startup()
+
+    metrics.gauge('delivery_queue_depth', 'Entries waiting in the delivery queues', lambda: {(name,): len(DeliveryQueue(name, redis_conn)) for name in (SUMMARIES, NOTIFICATIONS)}, ['queue'])
+    metrics.gauge('rq_queue_depth', 'Jobs waiting in the summary queues', lambda: {(name,): stats['depth'] for name, stats in queue_stats(redis_conn, QUEUES).items()}, ['queue'])
+    metrics.gauge('core_cache_size', 'Chats held in the Core cache', lambda: {(): len(cores)})
+    metrics.serve()
     
-    # Start Redis queue polling in a background thread
-    print("[BOT] Starting Redis queue polling thread...")
-    polling_thread = threading.Thread(target=poll_redis_queues, daemon=True)
-    polling_thread.start()
+    # Start Redis delivery queue consumers in background threads
+    log.info("Starting Redis queue polling threads")
+    summaries_thread = threading.Thread(target=outbound.consume, args=(SUMMARIES, _deliver_summary, redis.Redis(host=os.getenv('REDIS_HOST')), POP_TIMEOUT, _summary_delivered, _delivery_dropped), daemon=True)
+    summaries_thread.start()
+    notifications_thread = threading.Thread(target=outbound.consume, args=(NOTIFICATIONS, _deliver_notification, redis.Redis(host=os.getenv('REDIS_HOST')), POP_TIMEOUT, None, _delivery_dropped), daemon=True)
+    notifications_thread.start()
+
+    digest_thread = threading.Thread(target=digest.run, daemon=True)
+    digest_thread.start()
 
-    print("[BOT] Starting database cleanup thread...")
+    log.info("Starting database cleanup thread")
     cleaning_thread = threading.Thread(target=cleaner, daemon=True)
     cleaning_thread.start()
 
-    print("[BOT] Starting deductor thread...")
+    log.info("Starting deductor thread")
     deductor_thread = threading.Thread(target=deductor_d, daemon=True)
     deductor_thread.start()
     
     # Start the bot
-    print("[BOT] Bot ready, starting infinity polling...")
-    bot.infinity_polling()
+    if RUNTIME == 'async':
+        log.info("Bot ready, starting async runtime")
+        run_async(bot)
+    elif RUNTIME == 'webhook':
+        log.info("Bot ready, starting webhook receiver")
+        run_webhook(bot, WEBHOOK_SECRET, os.getenv('WEBHOOK_HOST', '127.0.0.1'), int(os.getenv('WEBHOOK_PORT', 8443)), os.getenv('WEBHOOK_PATH', '/webhook'), public_url=os.getenv('WEBHOOK_URL'))
+    else:
+        log.info("Bot ready, starting infinity polling")
+        bot.infinity_polling()
@@ -1,19 +1,46 @@
 import os
+import atexit
 
 import redis
-from rq import SimpleWorker
+from core.schema import migrate
+from core.llm_gateway import get_gateway
+from core.supervisor import WorkerSupervisor, WORKER_PROCESSES
+from core.priority import WeightedWorker, QUEUES, queue_stats
+from core import metrics
+from core.log import get_logger
+
+# Priority queues, plus the old default queue so jobs enqueued before the upgrade still run
+WORKER_QUEUES = QUEUES + ['default']
+
+log = get_logger('worker')
 
 
 if __name__ == '__main__':
-    print("[WORKER] Starting Redis Queue worker...")
+    log.info("Starting Redis Queue worker")
+
+    migrate()
+    log.info("Database schema up to date")
+
+    if WORKER_PROCESSES > 1:
+        # Several worker processes, so that many LLM calls are in flight at once
+        log.info("Supervising worker processes", processes=WORKER_PROCESSES)
+        WorkerSupervisor(queues=WORKER_QUEUES).run()
+        raise SystemExit(0)
+
+    # Build the shared LLM client up front so the first job does not pay for it
+    gateway = get_gateway()
+    atexit.register(gateway.close)
     
     # Connect to Redis
     redis_conn = redis.Redis(host=os.getenv('REDIS_HOST'))
-    print("[WORKER] Connected to Redis")
+    log.info("Connected to Redis")
+
+    metrics.gauge('rq_queue_depth', 'Jobs waiting in each queue', lambda: {(name,): stats['depth'] for name, stats in queue_stats(redis_conn, WORKER_QUEUES).items()}, ['queue'])
+    metrics.serve()
 
-    # Use SimpleWorker which doesn't fork processes
-    worker = SimpleWorker(queues=["default"], connection=redis_conn)
-    print("[WORKER] SimpleWorker initialized, waiting for jobs...")
+    # SimpleWorker (doesn't fork processes) with weighted fair queue selection
+    worker = WeightedWorker(queues=WORKER_QUEUES, connection=redis_conn)
+    log.info("WeightedWorker initialized, waiting for jobs", queues=",".join(WORKER_QUEUES))
 
     # Start processing jobs
     worker.work()
@@ -0,0 +1,11 @@
+"""
+Offline benchmarks.
+
+Everything runs against a temporary SQLite file, an in-process fake Redis
+(or a scratch redis-server) and stub Telegram/OpenAI endpoints, so no network
+access or credentials are needed:
+
+    pip install -r bench/requirements.txt
+    python -m bench.micro       # hot path micro-benchmarks
+    python -m bench.load        # end-to-end summary pipeline load test
+"""
@@ -0,0 +1,233 @@
+"""
+Shared benchmark plumbing: an isolated environment, timing and result files.
+
+`prepare` must run before anything from core, bookkeeping or app is imported,
+since those modules read their configuration from the environment at import.
+"""
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Below this, p95 is mostly timer and scheduler noise and is not compared
+MIN_P95_MS = 0.05
+
+WORDS = ('the', 'deploy', 'is', 'broken', 'again', 'can', 'someone', 'check', 'logs', 'i', 'think', 'it', 'was',
+         'the', 'migration', 'no', 'rollback', 'tonight', 'lunch', 'meeting', 'moved', 'to', 'three', 'who', 'has',
+         'access', 'staging', 'server', 'looks', 'fine', 'now', 'thanks', 'for', 'fixing', 'that', 'tomorrow')
+SHORT = ('ok', 'lol', '+1', 'thanks', 'yes', 'no', '👍')
+
+
+def prepare(redis_host=None, env=None):
+    """
+    Point the app at a temporary database and a throwaway Redis.
+
+    Args:
+        redis_host: scratch redis-server to use; None runs an in-process fakeredis
+        env: extra environment overrides
+
+    Returns:
+        the temporary working directory
+    """
+    workdir = tempfile.mkdtemp(prefix='dnrbot-bench-')
+    os.environ.update({
+        'SQL_PATH': os.path.join(workdir, 'bench.db'),
+        'BOT_TOKEN': '0:bench',
+        'BOTUSERNAME': '@benchbot',
+        'NOTIFIEE_ID': '1',
+        'OPENAI_KEY': 'bench',
+        'PROMPT_PATH': os.path.join(workdir, 'prompt.txt'),
+        'LOG_LEVEL': 'WARNING',
+        'METRICS_PORT': '',
+        # Summaries read the plain window; rolling buckets are a separate path
+        'SUMMARY_BUCKET_SECONDS': '0',
+    })
+    os.environ.update(env or {})
+    with open(os.environ['PROMPT_PATH'], 'w') as f:
+        f.write("Summarize the conversation below in a few short paragraphs.\n")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    if redis_host:
+        os.environ['REDIS_HOST'] = redis_host
+    else:
+        import fakeredis
+        import redis
+
+        server = fakeredis.FakeServer()
+        redis.Redis = lambda *args, **kwargs: fakeredis.FakeRedis(server=server)
+
+    from core.schema import migrate
+    migrate()
+    return workdir
+
+
+class StubBot:
+    """Stands in for telebot.TeleBot: every API method succeeds instantly and is counted"""
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            with self.lock:
+                self.calls[name] = self.calls.get(name, 0) + 1
+            return types.SimpleNamespace(message_id=next(self.ids), id=0, title='Bench chat', first_name=None)
+
+        return call
+
+
+def load_bot(stub=True):
+    """
+    Import app/bot.py without starting it.
+
+    Args:
+        stub: swap its Telegram client for a StubBot; False keeps the real
+            client, e.g. when telebot is pointed at a stub Bot API server
+    """
+    spec = importlib.util.spec_from_file_location('bot', os.path.join(ROOT, 'app', 'bot.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if stub:
+        # Handlers look `bot` up at call time, so they all reach the stub
+        module.bot = module.outbound.bot = StubBot()
+    return module
+
+
+def synthetic_rows(chat_id, count, seed=0, users=40, window=86400, first_id=1):
+    """Message rows (id, uid, chat_id, text, time, user, reply) spread over the last `window` seconds"""
+    rng = random.Random(seed)
+    start = int(time.time()) - window + 60
+    step = (window - 120) / max(count, 1)
+    rows = []
+    for i in range(count):
+        uid = rng.randrange(users)
+        mid = first_id + i
+        if rng.random() < 0.15:
+            text = rng.choice(SHORT)
+        else:
+            text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 40)))
+        reply = rng.randrange(first_id, mid) if mid > first_id and rng.random() < 0.2 else 0
+        rows.append((mid, uid, chat_id, text, start + int(i * step), f'User {uid}', reply))
+    return rows
+
+
+def telegram_message(mid, chat_id, uid, text):
+    import telebot
+
+    return telebot.types.Message.de_json({
+        'message_id': mid,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'Chat {chat_id}'},
+        'from': {'id': uid, 'is_bot': False, 'first_name': 'User', 'last_name': str(uid)},
+        'text': text,
+    })
+
+
+def percentile(ordered, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def measure(op, iterations, setup=None, finish=None, warmup=0):
+    """
+    Time `op(i)` for i in range(iterations).
+
+    Args:
+        setup: untimed callable run before each op with the same index
+        finish: timed callable run once at the end, e.g. to drain a write-behind
+            buffer; it counts towards ops/sec but not towards the per-op latencies
+
+    Returns:
+        dict of iterations, ops_per_sec and latency stats in milliseconds
+    """
+    for i in range(warmup):
+        if setup:
+            setup(i)
+        op(i)
+
+    latencies = []
+    for i in range(iterations):
+        if setup:
+            setup(i)
+        start = time.perf_counter()
+        op(i)
+        latencies.append(time.perf_counter() - start)
+
+    total = sum(latencies)
+    if finish:
+        start = time.perf_counter()
+        finish()
+        total += time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'ops_per_sec': round(iterations / total, 2) if total else 0,
+        'mean_ms': round(total / iterations * 1000, 4),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 4),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 4),
+        'max_ms': round(latencies[-1] * 1000, 4),
+    }
+
+
+def report(results, columns=('ops_per_sec', 'p50_ms', 'p95_ms', 'p99_ms')):
+    width = max([len(name) for name in results] + [9])
+    lines = [f"{'benchmark':<{width}}  " + '  '.join(f'{column:>12}' for column in columns)]
+    for name, result in results.items():
+        lines.append(f'{name:<{width}}  ' + '  '.join(f'{result.get(column, 0):>12}' for column in columns))
+    return '\n'.join(lines)
+
+
+def save(path, results, **meta):
+    document = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        **meta,
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2)
+        f.write('\n')
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def compare(results, baseline, tolerance):
+    """
+    Benchmarks slower than the baseline by more than `tolerance` (a fraction),
+    either in throughput or in p95 latency. Benchmarks missing on either side are skipped.
+
+    Returns:
+        list of human readable regressions
+    """
+    regressions = []
+    for name, base in baseline.items():
+        current = results.get(name)
+        if current is None:
+            continue
+        if base['ops_per_sec'] and current['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append(f"{name}: {current['ops_per_sec']} ops/s, baseline {base['ops_per_sec']}")
+        if base['p95_ms'] >= MIN_P95_MS and current['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {current['p95_ms']} ms, baseline {base['p95_ms']}")
+    return regressions
@@ -0,0 +1,268 @@
+"""
+End-to-end load test of the summary pipeline against local stub servers.
+
+    python -m bench.load --groups 100 --workers 8 --llm-latency 1 --tokens-per-sec 40
+
+Every group sends /summary through the bot's handle_message, so a request
+takes the production path: Core.summ, an RQ priority queue, a worker running
+llm_gateway.job against StubLLMServer, the Redis delivery queue, the
+outbound dispatcher and finally sendMessage on StubTelegramServer. Groups run
+concurrently, each making --requests requests one after the other.
+
+Turnaround is split into stages per request:
+    accept      /summary handled: window read, transcript built, job enqueued
+    queue_wait  job enqueued -> started by a worker
+    job         started -> summary pushed to the delivery queue (mostly the LLM call)
+    delivery    pushed -> sendMessage received by the Telegram stub
+    total       /summary received -> sendMessage received
+
+Workers run as threads against an in-process fakeredis, or with
+--redis-host as app/worker.py processes against a scratch redis-server.
+Outbound rate limits stay at their production values unless overridden, so
+delivery of a large burst is paced like it would be against Telegram.
+"""
+import argparse
+import datetime
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from bench import harness
+from bench.stubs import StubLLMServer, StubTelegramServer, SUMMARY_PREFIX, SUMMARY_END
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STAGES = ('accept', 'queue_wait', 'job', 'delivery', 'total')
+FIRST_GROUP = -10 ** 6
+
+
+def _epoch(moment):
+    # RQ keeps naive UTC datetimes
+    return moment.replace(tzinfo=datetime.timezone.utc).timestamp() if moment is not None else None
+
+
+def _summary(values):
+    ordered = sorted(values)
+    if not ordered:
+        return {'count': 0}
+    return {
+        'count': len(ordered),
+        'p50_ms': round(harness.percentile(ordered, 50) * 1000, 1),
+        'p95_ms': round(harness.percentile(ordered, 95) * 1000, 1),
+        'p99_ms': round(harness.percentile(ordered, 99) * 1000, 1),
+        'max_ms': round(ordered[-1] * 1000, 1),
+    }
+
+
+class Deliveries:
+    """Summary messages seen by the Telegram stub, and when they were queued for delivery"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.delivered = {}
+        self.queued = {}
+
+    def on_message(self, chat_id, text):
+        if chat_id < 0 and text.startswith(SUMMARY_PREFIX) and text.endswith(SUMMARY_END):
+            with self.cond:
+                self.delivered.setdefault(chat_id, []).append(time.time())
+                self.cond.notify_all()
+
+    def on_pop(self, payload):
+        with self.cond:
+            self.queued.setdefault(payload['gid'], []).append(payload.get('queued_at'))
+
+    def wait(self, chat_id, count, timeout):
+        """Time the count-th summary reached chat_id, or None on timeout"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self.delivered.get(chat_id, ())) >= count, timeout):
+                return None
+            return self.delivered[chat_id][count - 1], self.queued.get(chat_id, [None] * count)[count - 1]
+
+
+def start_workers(count, redis_host):
+    """Start the RQ workers; returns the worker processes to stop, if any"""
+    if redis_host:
+        env = dict(os.environ, WORKER_PROCESSES=str(count), PYTHONPATH=harness.ROOT)
+        return [subprocess.Popen([sys.executable, os.path.join(harness.ROOT, 'app', 'worker.py')], env=env, cwd=harness.ROOT)]
+
+    import redis
+    from rq.timeouts import TimerDeathPenalty
+    from core.priority import WeightedWorker
+    from core.llm_gateway import get_gateway
+
+    # RQ's signal handling and job timeouts only work in the main thread
+    class ThreadWorker(WeightedWorker):
+        death_penalty_class = TimerDeathPenalty
+
+        def _install_signal_handlers(self):
+            pass
+
+    sys.path.insert(0, os.path.join(harness.ROOT, 'app'))
+    from worker import WORKER_QUEUES
+
+    get_gateway()
+    for i in range(count):
+        worker = ThreadWorker(WORKER_QUEUES, connection=redis.Redis(), name=f'load-{os.getpid()}-{i}')
+        threading.Thread(target=worker.work, kwargs={'logging_level': 'WARNING'}, name=f'worker-{i}', daemon=True).start()
+    return []
+
+
+def seed_groups(bot_module, groups, messages):
+    from core.partitions import get_message_store
+
+    store = get_message_store()
+    for i in range(groups):
+        gid = FIRST_GROUP - i
+        store.insert_many(harness.synthetic_rows(gid, messages, seed=i, window=3600))
+        core = bot_module._get_core(gid)
+        # Spread the groups over the tiers, and so over the priority queues
+        core.db.execute('UPDATE chats SET active = 1, tier = ?, interval = 3600 WHERE id = ?', (i % 4, gid))
+
+
+def run_group(bot_module, deliveries, tickets, index, requests, timeout):
+    from rq.job import Job
+
+    gid = FIRST_GROUP - index
+    core = bot_module._get_core(gid)
+    samples = []
+    for n in range(1, requests + 1):
+        # A new message moves the window on, so the request is not answered from the summary cache
+        bot_module.handle_message(harness.telegram_message(10 ** 6 + 2 * n, gid, index, f'request {n} is coming'))
+        core.db.execute('UPDATE chats SET last = 0 WHERE id = ?', (gid,))
+
+        start = time.time()
+        bot_module.handle_message(harness.telegram_message(10 ** 6 + 2 * n + 1, gid, index, '/summary@benchbot'))
+        accepted = time.time()
+
+        ticket = tickets.get(gid)
+        if not ticket:
+            samples.append({'error': 'rejected'})
+            continue
+
+        outcome = deliveries.wait(gid, n, timeout)
+        if outcome is None:
+            samples.append({'error': 'timeout'})
+            continue
+        delivered, queued_at = outcome
+
+        sample = {'accept': accepted - start, 'total': delivered - start}
+        if queued_at is not None:
+            sample['delivery'] = delivered - queued_at
+        if ticket.job_id is not None and queued_at is not None:
+            job = Job.fetch(ticket.job_id, connection=core.redis_conn)
+            enqueued, started = _epoch(job.enqueued_at), _epoch(job.started_at)
+            if enqueued is not None and started is not None:
+                sample['queue_wait'] = started - enqueued
+                sample['job'] = queued_at - started
+        samples.append(sample)
+    return samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--groups', type=int, default=50, help='concurrent groups requesting summaries')
+    parser.add_argument('--requests', type=int, default=1, help='summary requests per group, made one after the other')
+    parser.add_argument('--messages', type=int, default=200, help='messages in each group window')
+    parser.add_argument('--workers', type=int, default=4, help='RQ workers (threads, or worker processes with --redis-host)')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='stub LLM time to first token, seconds')
+    parser.add_argument('--tokens-per-sec', type=float, default=50, help='stub LLM output rate')
+    parser.add_argument('--output-tokens', type=int, default=200, help='stub LLM summary length')
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help='stub Bot API response time, seconds')
+    parser.add_argument('--outbound-rate', type=float, help='global outbound messages per second (default: production limit)')
+    parser.add_argument('--stream', action='store_true', help='stream summaries (STREAM_SUMMARIES=True)')
+    parser.add_argument('--redis-host', help='scratch redis-server to use instead of the in-process fake')
+    parser.add_argument('--timeout', type=float, default=600, help='give up on a request after this many seconds')
+    parser.add_argument('--output', default=os.path.join(HERE, 'load.json'))
+    args = parser.parse_args(argv)
+
+    deliveries = Deliveries()
+    llm = StubLLMServer(args.llm_latency, args.tokens_per_sec, args.output_tokens).start()
+    telegram = StubTelegramServer(deliveries.on_message, args.telegram_latency).start()
+
+    env = {
+        'OPENAI_BASE_URL': llm.url,
+        'OPENAI_MODEL': 'stub',
+        'STREAM_SUMMARIES': str(args.stream),
+    }
+    if args.outbound_rate:
+        env['OUTBOUND_RATE'] = str(args.outbound_rate)
+    harness.prepare(redis_host=args.redis_host, env=env)
+
+    import redis
+    import telebot
+    from core.core import Core
+    from core.delivery import SUMMARIES
+
+    telebot.apihelper.API_URL = telegram.api_url
+    bot_module = harness.load_bot(stub=False)
+
+    # Keep each group's latest ticket to find its job afterwards
+    tickets = {}
+    summ = Core.summ
+
+    def recording_summ(self, uid, interval=None):
+        tickets[self.id] = ticket = summ(self, uid, interval)
+        return ticket
+
+    Core.summ = recording_summ
+
+    seed_groups(bot_module, args.groups, args.messages)
+    processes = start_workers(args.workers, args.redis_host)
+
+    def deliver(payload):
+        deliveries.on_pop(payload)
+        bot_module._deliver_summary(payload)
+
+    threading.Thread(target=bot_module.outbound.consume, args=(SUMMARIES, deliver, redis.Redis(host=os.getenv('REDIS_HOST')), 1, bot_module._summary_delivered), daemon=True).start()
+
+    results = [None] * args.groups
+
+    def run(index):
+        try:
+            results[index] = run_group(bot_module, deliveries, tickets, index, args.requests, args.timeout)
+        except Exception as e:
+            results[index] = [{'error': repr(e)}]
+
+    started = time.time()
+    threads = [threading.Thread(target=run, args=(i,), name=f'group-{i}') for i in range(args.groups)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+    samples = [sample for group in results for sample in group]
+    completed = [sample for sample in samples if 'error' not in sample]
+    errors = {}
+    for sample in samples:
+        if 'error' in sample:
+            errors[sample['error']] = errors.get(sample['error'], 0) + 1
+
+    stages = {stage: _summary([sample[stage] for sample in completed if stage in sample]) for stage in STAGES}
+    report = {
+        'config': vars(args),
+        'requests': len(samples),
+        'completed': len(completed),
+        'errors': errors,
+        'elapsed_s': round(elapsed, 2),
+        'throughput_per_s': round(len(completed) / elapsed, 2) if elapsed else 0,
+        'stages': stages,
+        'llm': dict(_summary(llm.durations), peak_concurrency=llm.peak),
+        'telegram_calls': telegram.calls,
+    }
+
+    print(f"{len(completed)}/{len(samples)} summaries delivered in {report['elapsed_s']}s "
+          f"({report['throughput_per_s']}/s){', errors: ' + str(errors) if errors else ''}")
+    print(harness.report(dict(stages, llm_server=report['llm']), columns=('count', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')))
+    harness.save(args.output, report)
+    return 0 if completed and not errors else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
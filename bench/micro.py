@@ -0,0 +1,166 @@
+"""
+Micro-benchmarks for the ingestion and command hot paths.
+
+    python -m bench.micro                        # run, compare with bench/baseline.json
+    python -m bench.micro --sizes 1000,10000     # smaller message windows
+    python -m bench.micro --save-baseline        # record this machine's numbers as the baseline
+
+Results are written to bench/results.json. The run exits with status 1 when a
+benchmark is slower than the baseline by more than --tolerance, in ops/sec or
+in p95 latency. Baselines are machine specific: record one on the machine that
+runs the comparison.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+from bench import harness
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = '1000,10000,100000,1000000'
+WINDOW = 86400
+
+COMMANDS = ('/summary@benchbot', '/summary', '/status@benchbot', '/show@benchbot', '/help@benchbot', '/tier@benchbot pro',
+            '/tier@benchbot gold', '/pay@benchbot 100', '/pay@benchbot abc', '/loglevel@benchbot debug 0.5',
+            '/stats@benchbot', '/unknown@benchbot', 'just a regular message', '')
+
+
+def bench_parse(results, iterations):
+    from core.command_parser import CommandParser
+
+    parser = CommandParser(bot_username='@benchbot')
+    results['command_parser.parse'] = harness.measure(lambda i: parser.parse(COMMANDS[i % len(COMMANDS)]), iterations, warmup=100)
+
+
+def bench_handle_message(results, bot_module, iterations):
+    rng = random.Random(1)
+    texts = [' '.join(rng.choice(harness.WORDS) for _ in range(rng.randint(3, 40))) for _ in range(200)]
+    messages = [harness.telegram_message(i, -1000 - i % 50, i % 40, texts[i % len(texts)]) for i in range(iterations)]
+    results['handle_message.text'] = harness.measure(
+        lambda i: bot_module.handle_message(messages[i]), iterations, finish=bot_module.ingest.flush, warmup=50)
+
+    commands = ('/status@benchbot', '/show@benchbot', '/help@benchbot', '/tier@benchbot gold', '/nonsense@benchbot')
+    messages = [harness.telegram_message(i, -1000 - i % 50, i % 40, commands[i % len(commands)]) for i in range(iterations // 10)]
+    results['handle_message.command'] = harness.measure(lambda i: bot_module.handle_message(messages[i]), len(messages), warmup=20)
+
+
+def bench_new_message(results, iterations):
+    from core.core import Core
+    from core.ingest import MessageBuffer
+
+    ingest = MessageBuffer()
+    rows = harness.synthetic_rows(-2000, iterations, seed=2)
+    buffered = Core(-2000, ingest=ingest)
+    results['core.new_message'] = harness.measure(
+        lambda i: buffered.new_message(rows[i][0], rows[i][1], rows[i][4], rows[i][3], rows[i][5], rows[i][6]),
+        iterations, finish=ingest.flush)
+    ingest.close()
+
+    # Without a buffer every message is its own INSERT and commit
+    rows = harness.synthetic_rows(-2001, iterations // 10, seed=3)
+    direct = Core(-2001)
+    results['core.new_message.unbuffered'] = harness.measure(
+        lambda i: direct.new_message(rows[i][0], rows[i][1], rows[i][4], rows[i][3], rows[i][5], rows[i][6]),
+        len(rows))
+
+
+def bench_get_messages(results, sizes):
+    from core.core import Core
+    from core.partitions import get_message_store
+
+    store = get_message_store()
+    for size in sizes:
+        chat_id = -3000 - size
+        rows = harness.synthetic_rows(chat_id, size, seed=size)
+        for i in range(0, len(rows), 50000):
+            store.insert_many(rows[i:i + 50000])
+        del rows
+
+        core = Core(chat_id)
+        results[f'core._get_messages[{size}]'] = harness.measure(
+            lambda i: core._get_messages(WINDOW), max(3, min(100, 200000 // size)), warmup=1)
+
+
+def bench_summ(results, iterations, size=1000):
+    from core.core import Core
+    from core.ingest import MessageBuffer
+    from core.partitions import get_message_store
+
+    chat_id = -4000
+    get_message_store().insert_many(harness.synthetic_rows(chat_id, size, seed=4, window=3600))
+
+    ingest = MessageBuffer()
+    core = Core(chat_id, ingest=ingest)
+    core.db.execute('UPDATE chats SET active = 1, tier = 3, interval = 3600 WHERE id = ?', (chat_id,))
+
+    def setup(i):
+        # A fresh message per request changes the window, so each one enqueues a job
+        core.db.execute('UPDATE chats SET last = 0 WHERE id = ?', (chat_id,))
+        core.new_message(size + 1 + i, i % 40, int(time.time()), 'one more thing', f'User {i % 40}')
+
+    results['core.summ'] = harness.measure(lambda i: core.summ(i % 40), iterations, setup=setup, warmup=2)
+    ingest.close()
+
+
+def bench_deduct(results, iterations, chats=10000):
+    from core.db import get_db
+    from bookkeeping.deductor import deduct
+
+    db = get_db()
+    now = int(time.time())
+    first = 10 ** 9
+    # Half of the chats can afford their tier, half lapse
+    db.executemany('INSERT INTO chats (id, interval, last, summ, balance, payed_date, active, tier) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                   [(first + i, 3600, 0, '', 10 ** 6 if i % 2 else 0, 0, 1, 1 + i % 3) for i in range(chats)])
+
+    def setup(i):
+        db.execute('UPDATE chats SET payed_date = 0, active = 1 WHERE id >= ?', (first,))
+
+    results[f'deduct[{chats}]'] = harness.measure(lambda i: deduct(db, now), iterations, setup=setup)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma separated message counts for the _get_messages windows')
+    parser.add_argument('--iterations', type=int, default=20000, help='operations for the per-message benchmarks')
+    parser.add_argument('--redis-host', help='scratch redis-server to use instead of the in-process fake')
+    parser.add_argument('--output', default=os.path.join(HERE, 'results.json'))
+    parser.add_argument('--baseline', default=os.path.join(HERE, 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed slowdown before failing, as a fraction')
+    args = parser.parse_args(argv)
+
+    harness.prepare(redis_host=args.redis_host)
+    bot_module = harness.load_bot()
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+
+    results = {}
+    bench_parse(results, args.iterations * 5)
+    bench_handle_message(results, bot_module, args.iterations)
+    bench_new_message(results, args.iterations)
+    bench_get_messages(results, sizes)
+    bench_summ(results, max(50, args.iterations // 100))
+    bench_deduct(results, 20)
+    bot_module.ingest.close()
+
+    print(harness.report(results))
+    harness.save(args.output, results, sizes=sizes)
+    if args.save_baseline:
+        harness.save(args.baseline, results, sizes=sizes)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one")
+        return 0
+
+    regressions = harness.compare(results, harness.load(args.baseline), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
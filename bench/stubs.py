@@ -0,0 +1,222 @@
+"""
+Local HTTP stand-ins for the OpenAI Responses API and the Telegram Bot API.
+
+StubLLMServer answers POST /v1/responses after a configurable time to first
+token plus output_tokens / tokens_per_sec, in plain or streamed (SSE) form.
+Point the OpenAI client at it with OPENAI_BASE_URL=<server.url>.
+
+StubTelegramServer answers every /bot<token>/<method> call with a plausible
+result and reports sent messages to a callback. Point telebot at it with
+telebot.apihelper.API_URL = server.api_url.
+"""
+import http.server
+import itertools
+import json
+import threading
+import time
+import urllib.parse
+
+# Complete stub summaries start and end with these, so deliveries can be told
+# from other bot messages and from partially streamed text
+SUMMARY_PREFIX = 'Stub summary'
+SUMMARY_END = '(end)'
+
+
+class _Server:
+    handler = None
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.httpd = http.server.ThreadingHTTPServer((host, port), self.handler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.host, self.port = self.httpd.server_address[:2]
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _LLMHandler(_Handler):
+    def do_POST(self):
+        stub = self.server.stub
+        request = json.loads(self._body() or b'{}')
+        if self.path.rstrip('/') != '/v1/responses':
+            self._json({'error': {'message': f'Unknown path {self.path}'}}, 404)
+            return
+
+        start = time.perf_counter()
+        with stub.lock:
+            stub.active += 1
+            stub.peak = max(stub.peak, stub.active)
+        try:
+            if request.get('stream'):
+                self._stream(stub, request)
+            else:
+                time.sleep(stub.latency + stub.output_tokens / stub.tokens_per_sec)
+                self._json(stub.response(request))
+        finally:
+            with stub.lock:
+                stub.active -= 1
+                stub.durations.append(time.perf_counter() - start)
+
+    def _stream(self, stub, request):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        response = stub.response(request)
+        text = response['output'][0]['content'][0]['text']
+        words = text.split(' ')
+        sequence = itertools.count()
+
+        def event(payload):
+            payload['sequence_number'] = next(sequence)
+            self.wfile.write(f"event: {payload['type']}\ndata: {json.dumps(payload)}\n\n".encode())
+            self.wfile.flush()
+
+        time.sleep(stub.latency)
+        # Emit a delta every STREAM_CHUNK words, paced at tokens_per_sec (one token per word)
+        for i in range(0, len(words), StubLLMServer.STREAM_CHUNK):
+            chunk = words[i:i + StubLLMServer.STREAM_CHUNK]
+            time.sleep(len(chunk) / stub.tokens_per_sec)
+            delta = ' '.join(chunk) + (' ' if i + len(chunk) < len(words) else '')
+            event({'type': 'response.output_text.delta', 'item_id': response['output'][0]['id'], 'output_index': 0, 'content_index': 0, 'delta': delta})
+        event({'type': 'response.completed', 'response': response})
+
+
+class StubLLMServer(_Server):
+    """Responses API stub; each output token is one word of the summary"""
+
+    handler = _LLMHandler
+    STREAM_CHUNK = 10
+
+    def __init__(self, latency=0.5, tokens_per_sec=50, output_tokens=200, host='127.0.0.1', port=0):
+        super().__init__(host, port)
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.output_tokens = output_tokens
+        self.ids = itertools.count(1)
+        self.active = 0
+        self.peak = 0
+        self.durations = []
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}/v1'
+
+    def response(self, request):
+        n = next(self.ids)
+        prompt = str(request.get('input', ''))
+        text = ' '.join([SUMMARY_PREFIX, f'#{n}:'] + ['word'] * max(self.output_tokens - 3, 0) + [SUMMARY_END])
+        return {
+            'id': f'resp_{n}',
+            'object': 'response',
+            'created_at': int(time.time()),
+            'status': 'completed',
+            'model': request.get('model') or 'stub',
+            'output': [{
+                'type': 'message',
+                'id': f'msg_{n}',
+                'status': 'completed',
+                'role': 'assistant',
+                'content': [{'type': 'output_text', 'text': text, 'annotations': []}],
+            }],
+            'parallel_tool_calls': False,
+            'tool_choice': 'auto',
+            'tools': [],
+            'usage': {
+                'input_tokens': len(prompt) // 4,
+                'input_tokens_details': {'cached_tokens': 0},
+                'output_tokens': self.output_tokens,
+                'output_tokens_details': {'reasoning_tokens': 0},
+                'total_tokens': len(prompt) // 4 + self.output_tokens,
+            },
+        }
+
+
+class _TelegramHandler(_Handler):
+    def _handle(self):
+        stub = self.server.stub
+        parsed = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            params.update(urllib.parse.parse_qsl(self._body().decode()))
+        else:
+            self._body()
+        method = parsed.path.rsplit('/', 1)[-1]
+
+        if stub.latency:
+            time.sleep(stub.latency)
+        with stub.lock:
+            stub.calls[method] = stub.calls.get(method, 0) + 1
+
+        self._json({'ok': True, 'result': stub.result(method, params)})
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class StubTelegramServer(_Server):
+    """Bot API stub; `on_message(chat_id, text)` is called for every sendMessage and editMessageText"""
+
+    handler = _TelegramHandler
+
+    def __init__(self, on_message=None, latency=0, host='127.0.0.1', port=0):
+        super().__init__(host, port)
+        self.on_message = on_message
+        self.latency = latency
+        self.calls = {}
+        self.ids = itertools.count(1)
+
+    @property
+    def api_url(self):
+        return f'http://{self.host}:{self.port}/bot{{0}}/{{1}}'
+
+    @staticmethod
+    def chat(chat_id):
+        chat_id = int(chat_id)
+        if chat_id < 0:
+            return {'id': chat_id, 'type': 'supergroup', 'title': f'Load chat {chat_id}'}
+        return {'id': chat_id, 'type': 'private', 'first_name': f'User {chat_id}'}
+
+    def result(self, method, params):
+        if method in ('sendMessage', 'editMessageText'):
+            if self.on_message is not None:
+                self.on_message(int(params['chat_id']), params.get('text', ''))
+            return {
+                'message_id': int(params.get('message_id') or next(self.ids)),
+                'date': int(time.time()),
+                'chat': self.chat(params['chat_id']),
+                'text': params.get('text', ''),
+            }
+        if method == 'getChat':
+            return self.chat(params['chat_id'])
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'benchbot'}
+        return True
@@ -0,0 +1,124 @@
+"""
+Process-wide, in-memory catalog of subscription tiers and their prices.
+
+The prices table is loaded once and served from memory. Triggers on the
+table bump catalog_version on every change, which the catalog polls at most
+every PRICES_CHECK_INTERVAL seconds; `reload()` forces an immediate reload.
+"""
+import os
+import threading
+import time
+
+from core.db import get_db
+from core.log import get_logger
+
+log = get_logger('catalog')
+
+TIER_NAMES = ["FREE", "BASIC", "PLUS", "PRO", "MAX", "ELITE"]
+TIER_ICONS = ["🆓", "🥉", "🥈", "🥇", "💎", "👑"]
+
+DEFAULT_INTERVAL = 1440  # minutes, used when the prices table has no free tier
+
+
+def format_cooldown(interval_minutes):
+    if interval_minutes >= 1440:  # >= 24 hours
+        return f"{interval_minutes // 1440} day{'s' if interval_minutes // 1440 > 1 else ''}"
+    elif interval_minutes >= 60:  # >= 1 hour
+        return f"{interval_minutes // 60} hr{'s' if interval_minutes // 60 > 1 else ''}"
+    return f"{interval_minutes} min"
+
+
+def tier_name(tier_id):
+    return TIER_NAMES[tier_id] if tier_id < len(TIER_NAMES) else f"TIER {tier_id}"
+
+
+def tier_label(tier_id):
+    """Tier name with its icon, e.g. '🥉 BASIC'"""
+    return f"{TIER_ICONS[tier_id]} {TIER_NAMES[tier_id]}" if tier_id < len(TIER_NAMES) else f"TIER {tier_id}"
+
+
+class Tier:
+    def __init__(self, tier_id, price, interval):
+        self.id = tier_id
+        self.price = price
+        self.interval = interval  # minutes
+
+    @property
+    def label(self):
+        return tier_label(self.id)
+
+    @property
+    def cooldown(self):
+        return format_cooldown(self.interval)
+
+
+class PriceCatalog:
+    def __init__(self, db=None, check_interval=None):
+        self.db = db if db is not None else get_db()
+        self.check_interval = int(check_interval if check_interval is not None else os.getenv('PRICES_CHECK_INTERVAL', 60))
+
+        self.lock = threading.Lock()
+        self.tiers_by_id = {}
+        self.version = None
+        self.checked_at = 0
+
+        self.reload()
+
+    def reload(self):
+        with self.lock:
+            version = self._read_version()
+            rows = self.db.fetchall("SELECT id, price, interval FROM prices ORDER BY id")
+            self.tiers_by_id = {tier_id: Tier(tier_id, price, interval) for tier_id, price, interval in rows}
+            self.version = version
+            self.checked_at = time.monotonic()
+
+        log.info("Loaded tiers", tiers=len(self.tiers_by_id), version=version)
+
+    def _read_version(self):
+        row = self.db.fetchone("SELECT version FROM catalog_version")
+        return row[0] if row else 0
+
+    def _maybe_refresh(self):
+        if time.monotonic() - self.checked_at < self.check_interval:
+            return
+
+        self.checked_at = time.monotonic()
+        if self._read_version() != self.version:
+            self.reload()
+
+    def tiers(self):
+        self._maybe_refresh()
+        return [self.tiers_by_id[tier_id] for tier_id in sorted(self.tiers_by_id)]
+
+    def get(self, tier_id):
+        self._maybe_refresh()
+        return self.tiers_by_id.get(tier_id)
+
+    def price(self, tier_id):
+        tier = self.get(tier_id)
+        if tier is None:
+            raise KeyError(tier_id)
+        return tier.price
+
+    def interval(self, tier_id):
+        """Cooldown of a tier in minutes, or None if the tier does not exist"""
+        tier = self.get(tier_id)
+        return tier.interval if tier is not None else None
+
+    def default_interval(self):
+        """Cooldown of the free tier in minutes"""
+        interval = self.interval(0)
+        return interval if interval is not None else DEFAULT_INTERVAL
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = PriceCatalog()
+    return _catalog
@@ -1,16 +1,11 @@
-import sqlite3
-import dotenv
-import os
-
-from bookkeeping.deductor import process_group
+from core.db import get_db
+from bookkeeping.catalog import get_catalog
+from bookkeeping.deductor import process_group, wake
 
 
 class BKCore:
-    def __init__(self):
-        dotenv.load_dotenv()
-        path = os.getenv('SQL_PATH')
-        self.connection = sqlite3.connect(path)
-        self.cursor = self.connection.cursor()
+    def __init__(self, db=None):
+        self.db = db if db is not None else get_db()
 
     def handle_group_update(self, tier_id, gid):
         # 0 - free | 6h
@@ -23,34 +18,33 @@ class BKCore:
             return False
 
         # set tier to new tier
-        # call deductor with check_date=False
+        # and charge for it right away
 
-        old_tier = self.cursor.execute("SELECT tier FROM chats WHERE id = ?", (gid,)).fetchone()[0]
+        old_tier = self.db.fetchone("SELECT tier FROM chats WHERE id = ?", (gid,))[0]
 
         if old_tier == tier_id:
             return False
 
-        self.cursor.execute('UPDATE chats SET tier = ? WHERE id = ?', (tier_id, gid))
-        self.connection.commit()
-        process_group(gid, in_cursor=self.cursor, check_date=False)
+        with self.db.transaction():
+            self.db.execute('UPDATE chats SET tier = ? WHERE id = ?', (tier_id, gid))
+            process_group(gid, db=self.db)
 
         return True
 
     def group_payed(self, gid, amount):
-        old_amount = self.cursor.execute('SELECT balance FROM chats WHERE id = ?', (gid,)).fetchone()[0]
-        self.cursor.execute('UPDATE chats SET balance = ? WHERE id = ?', (old_amount + amount, gid))
-        self.connection.commit()
+        self.db.execute('UPDATE chats SET balance = balance + ? WHERE id = ?', (amount, gid))
+        # A lapsed chat may now afford its renewal
+        wake()
 
     def update_group_intervals(self):
-        gids = self.cursor.execute("SELECT id, tier FROM chats").fetchall()
-
-        for gid, tier in gids:
-            interval_result = self.cursor.execute("SELECT interval FROM prices WHERE id = ?", (tier,)).fetchone()
-            if interval_result:
-                interval_minutes = interval_result[0]  # Extract the actual value from tuple
-                interval_seconds = interval_minutes * 60  # Convert minutes to seconds
-                self.cursor.execute("UPDATE chats SET interval = ? WHERE id = ?", (interval_seconds, gid))
+        with self.db.transaction():
+            gids = self.db.fetchall("SELECT id, tier FROM chats")
 
-        self.connection.commit()
+            catalog = get_catalog()
 
+            for gid, tier in gids:
+                interval_minutes = catalog.interval(tier)
+                if interval_minutes is not None:
+                    interval_seconds = interval_minutes * 60  # Convert minutes to seconds
+                    self.db.execute("UPDATE chats SET interval = ? WHERE id = ?", (interval_seconds, gid))
 
@@ -1,84 +1,100 @@
-import sqlite3
 import os
 import time
-import datetime
+import threading
 
-from dateutil.relativedelta import relativedelta
+from core.db import get_db
+from bookkeeping.catalog import get_catalog
+from core.log import get_logger
 
-import dotenv
+log = get_logger('billing')
 
+# Longest the billing loop sleeps, even if no subscription expires sooner
+MAX_SLEEP = int(os.getenv('BILLING_MAX_SLEEP', 3600))
 
-def deduct():
-    dotenv.load_dotenv()
-    path = os.getenv('SQL_PATH')
-    connection = sqlite3.connect(path)
-    cursor = connection.cursor()
+# One month after payed_date (UTC). SQLite's '+1 month' rolls Jan 31 over to Mar 3,
+# so it is clamped to the same time of day on the last day of the next month
+EXPIRY = ("MIN(CAST(strftime('%s', chats.payed_date, 'unixepoch', '+1 month') AS INTEGER), "
+          "CAST(strftime('%s', chats.payed_date, 'unixepoch', 'start of month', '+2 months', '-1 day') AS INTEGER) + chats.payed_date % 86400)")
+# EXPIRY <= ?, with the date math only for chats paid 28 to 31 days before; takes the time three times
+DUE = f"(chats.payed_date + {31 * 86400} <= ? OR (chats.payed_date + {28 * 86400} <= ? AND {EXPIRY} <= ?))"
+PRICE = "(SELECT price FROM prices WHERE prices.id = chats.tier)"
 
-    gids = cursor.execute('SELECT id FROM chats').fetchall()
+_wake = threading.Event()
 
-    for (gid,) in gids:
-        # do deducting logic
-        process_group(gid, in_cursor=cursor)
 
-    connection.close()
+def wake():
+    """Make the billing loop re-check now, e.g. after a balance change"""
+    _wake.set()
 
 
-def process_group(gid, in_cursor=None, check_date=True):
-    if in_cursor is None:
-        dotenv.load_dotenv()
-        path = os.getenv('SQL_PATH')
-        connection = sqlite3.connect(path)
-        cursor = connection.cursor()
-    else:
-        cursor = in_cursor
+def deduct(db=None, now=None):
+    """
+    Renew or lapse every subscription that is due, in one transaction.
+
+    A chat is due once a month has passed since payed_date. Due chats that can
+    afford their tier are charged and renewed; active ones that cannot are
+    deactivated and fall back to the free cooldown until they top up.
+
+    Returns:
+        (renewed, lapsed) chat counts
+    """
+    db = db if db is not None else get_db()
+    now = int(now if now is not None else time.time())
+    default_interval = get_catalog().default_interval() * 60
 
-    prices = {}
+    with db.transaction():
+        lapsed = db.execute(
+            f'UPDATE chats SET active = 0, interval = ? WHERE {DUE} AND active = 1 AND balance < {PRICE}',
+            (default_interval, now, now, now))
+        renewed = db.execute(
+            f'UPDATE chats SET balance = balance - {PRICE}, payed_date = ?, active = 1, '
+            f'interval = (SELECT interval FROM prices WHERE prices.id = chats.tier) * 60 '
+            f'WHERE {DUE} AND balance >= {PRICE}',
+            (now, now, now, now))
 
-    # set prices
-    prices_l = cursor.execute("SELECT id, price FROM prices").fetchall()
-    for price in prices_l:
-        prices[price[0]] = price[1]
+    return renewed, lapsed
 
-    balance = cursor.execute("SELECT balance FROM chats WHERE id = ?", (gid,)).fetchone()[0]
-    tier = cursor.execute("SELECT tier FROM chats WHERE id = ?", (gid,)).fetchone()[0]
-    payed_date = cursor.execute("SELECT payed_date FROM chats WHERE id = ?", (gid,)).fetchone()[0]
 
-    if check_date:
-        payed_date = datetime.datetime.utcfromtimestamp(payed_date)
-        expiry_dt = payed_date + relativedelta(months=1)
-        expiry_dt = int(expiry_dt.timestamp())
+def next_expiry(db=None):
+    """Earliest time a chat becomes due, or None. Lapsed chats that cannot pay are not due"""
+    db = db if db is not None else get_db()
+    row = db.fetchone(f'SELECT MIN({EXPIRY}) FROM chats JOIN prices ON prices.id = chats.tier WHERE chats.active = 1 OR chats.balance >= prices.price')
+    return row[0]
 
-        if expiry_dt > time.time():
-            if in_cursor is None:
-                cursor.connection.close()
 
-            return
+def process_group(gid, db=None):
+    """Charge a chat for its tier now, e.g. after a tier change, or fall back to the free cooldown"""
+    db = db if db is not None else get_db()
+    catalog = get_catalog()
 
-    due = prices[tier]
+    balance, tier, payed_date = db.fetchone("SELECT balance, tier, payed_date FROM chats WHERE id = ?", (gid,))
+
+    due = catalog.price(tier)
     balance -= due
 
     if balance >= 0:
         payed_date = int(time.time())
-        cursor.execute(f'UPDATE chats SET payed_date = ?, balance = ? WHERE id = ?', (payed_date, balance, gid))
-        cursor.connection.commit()
         out = True
-        interval = cursor.execute('SELECT interval FROM prices WHERE id = ?', (tier,)).fetchone()[0]
+        interval = catalog.interval(tier)
     else:
-        # Get default interval from database for fallback
-        default_interval_result = cursor.execute('SELECT interval FROM prices WHERE id = 0').fetchone()
-        interval = default_interval_result[0] if default_interval_result else 1440
+        interval = catalog.default_interval()
         balance += due
         out = False
 
-    cursor.execute('UPDATE chats SET active = ?, interval = ? WHERE id = ?', (int(out), interval * 60, gid))
-    cursor.connection.commit()
-
-    if in_cursor is None:
-        cursor.connection.close()
+    with db.transaction():
+        if out:
+            db.execute('UPDATE chats SET payed_date = ?, balance = ? WHERE id = ?', (payed_date, balance, gid))
+        db.execute('UPDATE chats SET active = ?, interval = ? WHERE id = ?', (int(out), interval * 60, gid))
 
 
 def deductor_d():
     while 1:
-        deduct()
-        time.sleep(24 * 60 * 60)
+        renewed, lapsed = deduct()
+        log.info("Billing run", renewed=renewed, lapsed=lapsed)
+
+        # Sleep until the next subscription expires or a balance changes
+        expiry = next_expiry()
+        delay = MAX_SLEEP if expiry is None else min(max(expiry - time.time(), 1), MAX_SLEEP)
+        _wake.wait(delay)
+        _wake.clear()
 
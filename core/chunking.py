@@ -0,0 +1,60 @@
+"""
+Token-bounded splitting of chat transcripts for map-reduce summarization.
+
+Tokens are counted with tiktoken when it is installed and its encoding is
+available locally; otherwise a character-based estimate is used, so nothing
+here needs network access.
+"""
+import os
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+CHARS_PER_TOKEN = 4
+
+_encoding = None
+if tiktoken is not None:
+    try:
+        _encoding = tiktoken.get_encoding(os.getenv('TOKENIZER_ENCODING', 'o200k_base'))
+    except Exception:
+        # The encoding is downloaded on first use; stay offline-capable
+        _encoding = None
+
+
+def estimate_tokens(text):
+    """Token count of text, exact with tiktoken and a slight overestimate without"""
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=())) + 1
+
+    # Non-latin scripts (Cyrillic, CJK, emoji) take about two characters per token
+    wide = sum(1 for c in text if ord(c) > 0x7f)
+    return (len(text) + wide) // CHARS_PER_TOKEN + 1
+
+
+def split_chunks(lines, max_tokens):
+    """
+    Pack transcript lines, in order, into chunks of at most `max_tokens` tokens.
+    Lines longer than a whole chunk are cut into pieces.
+
+    Returns:
+        List of chunk strings
+    """
+    chunks, current, current_tokens = [], [], 0
+    max_chars = max_tokens * CHARS_PER_TOKEN
+
+    for line in lines:
+        pieces = [line[i:i + max_chars] for i in range(0, len(line), max_chars)] or ['']
+        for piece in pieces:
+            tokens = estimate_tokens(piece)
+            if current and current_tokens + tokens > max_tokens:
+                chunks.append('\n'.join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += tokens
+
+    if current:
+        chunks.append('\n'.join(current))
+
+    return chunks
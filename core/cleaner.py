@@ -1,14 +1,18 @@
-import sqlite3
-import dotenv
-import os
 import time
 
+from core.db import get_db
+from core.partitions import get_message_store
+from core.log import get_logger
+
+log = get_logger('cleaner')
+
+RETENTION = 1440 * 60
+
 
 def clean():
-    dotenv.load_dotenv()
-    path = os.getenv('SQL_PATH')
-    conn = sqlite3.connect(path)
+    cutoff = int(time.time()) - RETENTION
+
+    dropped, deleted = get_message_store().drop_before(cutoff)
+    log.info("Expired messages removed", partitions=dropped, rows=deleted)
 
-    conn.cursor().execute("DELETE FROM messages WHERE time < ?", [int(time.time()) - 1440 * 60])
-    conn.commit()
-    conn.close()
+    get_db().execute("DELETE FROM bucket_summaries WHERE bucket < ?", [cutoff])
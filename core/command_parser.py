@@ -28,6 +28,11 @@ class CommandParser:
             '?': (False, None),
             'help': (False, None),
             
+            # Admin commands
+            'stats': (False, None),
+            'reload': (False, None),
+            'loglevel': (True, self._validate_log_level),
+            
             # Parameter commands
             'tier': (True, self._validate_tier),
             'pay': (True, self._validate_amount),
@@ -127,6 +132,20 @@ class CommandParser:
             return False, "Invalid tier. Choose from: free, basic, plus, pro, max, elite"
         return True, None
 
+    def _validate_log_level(self, params, debug=False):
+        """Validate log level command parameters: level and optional sample rate"""
+        parts = params.split()
+        if parts[0].upper() not in {"DEBUG", "INFO", "WARNING", "ERROR"} or len(parts) > 2:
+            return False, "Usage: /loglevel <debug|info|warning|error> [message sample rate 0-1]"
+        if len(parts) == 2:
+            try:
+                rate = float(parts[1])
+            except ValueError:
+                return False, "Sample rate must be a number between 0 and 1"
+            if not 0 <= rate <= 1:
+                return False, "Sample rate must be a number between 0 and 1"
+        return True, None
+
     def _validate_amount(self, params, debug=False):
         """Validate payment amount parameters"""
         try:
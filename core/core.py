@@ -1,12 +1,26 @@
 import redis
 import rq
+from rq.job import Dependency, Job, JobStatus
+from rq.exceptions import NoSuchJobError
 import dotenv
-import sqlite3
 import os
 import time
-import json
-
-from core.llm_gateway import job
+import uuid
+
+from core.llm_gateway import job, map_job, reduce_job, bucket_job, rolling_job
+from core import rolling
+from core.chunking import split_chunks, estimate_tokens
+from core import transcript
+from core import metrics
+from core.log import get_logger
+from core.delivery import DeliveryQueue, NOTIFICATIONS, SUMMARIES
+from core.digest import NEW_CHAT
+from core.priority import QUEUES, queue_for
+from core.summary_cache import get_summary_cache, fingerprint
+from core.streaming import SummaryStream, new_stream_key
+from core.db import get_db
+from core.partitions import get_message_store
+from bookkeeping.catalog import get_catalog
 
 # Load notification settings
 dotenv.load_dotenv()
@@ -16,11 +30,40 @@ if NOTIFIEE_ID:
 else:
     NOTIFIEE_ID = 0
 
+STREAM_SUMMARIES = os.getenv('STREAM_SUMMARIES') == 'True'
+# Transcripts above this many tokens are summarized in parallel chunks, then merged
+CHUNK_TOKENS = int(os.getenv('SUMMARY_CHUNK_TOKENS', 12000))
+# Room left for transcript lines in a chunk, however much of it the legend takes
+MIN_CHUNK_TOKENS = CHUNK_TOKENS // 2
+MAP_RESULT_TTL = 3600
+# A window's in-flight marker outlives any reasonable job; it is cleared on delivery
+INFLIGHT_TTL = int(os.getenv('SUMMARY_INFLIGHT_TTL', 900))
+INFLIGHT_KEY = 'inflight:{}:{}'
+# Owner job states that still lead to a delivery; in any other the marker is stale
+LIVE_STATUSES = (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED)
+
+log = get_logger('core')
+
+
+class SummaryTicket:
+    """Accepted summary request"""
+
+    def __init__(self, job_id, stream=None, cached=False, attached=False):
+        self.job_id = job_id
+        self.stream = stream
+        self.cached = cached
+        # Joined a summary of the same window that was already queued or running
+        self.attached = attached
+
+    def __bool__(self):
+        return True
+
 
 class Core:
-    def __init__(self, gid):
-        print(f"[CORE] Initializing Core for chat {gid}")
+    def __init__(self, gid, ingest=None, db=None):
+        log.debug("Initializing Core", chat=gid)
         self.id = gid
+        self.ingest = ingest
         self.last = 0
         self.active = 0
         self.balance = 0
@@ -29,29 +72,24 @@ class Core:
         self.summary = "📄 No summary available. Use /summary to generate your first chat summary."
 
         self.redis_conn = redis.Redis(host=os.getenv('REDIS_HOST'))
-        self.rq = rq.Queue(connection=self.redis_conn)
+        self.queues = {name: rq.Queue(name, connection=self.redis_conn) for name in QUEUES}
+        self.notifications = DeliveryQueue(NOTIFICATIONS, self.redis_conn)
+        self.summaries = DeliveryQueue(SUMMARIES, self.redis_conn)
 
-        dotenv.load_dotenv()
-        path = os.getenv('SQL_PATH')
-
-        self.conn = sqlite3.connect(path)
-        self.cursor = self.conn.cursor()
+        self.db = db if db is not None else get_db()
+        self.store = get_message_store()
+        self.catalog = get_catalog()
         
-        # Load default interval from database after cursor is initialized
-        default_interval_result = self.cursor.execute("SELECT interval FROM prices WHERE id = 0").fetchone()
-        if default_interval_result:
-            self.interval = default_interval_result[0] * 60  # Convert minutes to seconds
-        else:
-            self.interval = 86400  # Fallback to 24 hours
+        self.interval = self.catalog.default_interval() * 60  # Convert minutes to seconds
 
         self.update()
-        print(f"[CORE] Core initialized for chat {gid}")
+        log.info("Core initialized", chat=gid)
 
     def update(self):
         # pull from sql
         # set fields
 
-        x = self.cursor.execute('SELECT summ, balance, interval, last, payed_date, active, tier FROM chats WHERE id = ?', (self.id,)).fetchall()
+        x = self.db.fetchall('SELECT summ, balance, interval, last, payed_date, active, tier FROM chats WHERE id = ?', (self.id,))
 
         if len(x) != 1:
             self._push(update=False)
@@ -66,14 +104,14 @@ class Core:
         self.summary, self.balance, self.interval, self.last, self.payed_date, self.active, self.tier = x
 
     def _push(self, update=True):
-        print(f"[CORE] Pushing chat data to DB for chat {self.id}")
+        log.debug("Pushing chat data to DB", chat=self.id)
         if update:
-            self.cursor.execute('UPDATE chats SET interval = ?, last = ?, summ = ?, balance = ?, payed_date = ?, active = ?, tier = ? WHERE id = ?', (self.interval, self.last, self.summary, self.balance, self.payed_date, self.active, self.tier, self.id))
+            # Only the columns Core owns: balance, tier and the subscription are written by BKCore and the deductor
+            self.db.execute('UPDATE chats SET last = ?, summ = ? WHERE id = ?', (self.last, self.summary, self.id))
         else:
-            self.cursor.execute('INSERT INTO chats (id, interval, last, summ, balance, payed_date, active, tier) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (self.id, self.interval, self.last, self.summary, self.balance, self.payed_date, self.active, self.tier))
+            self.db.execute('INSERT INTO chats (id, interval, last, summ, balance, payed_date, active, tier) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (self.id, self.interval, self.last, self.summary, self.balance, self.payed_date, self.active, self.tier))
             # Send notification for new chat
             self._notify_new_chat()
-        self.conn.commit()
     
     def _notify_new_chat(self):
         """Send notification about new chat to notifiee"""
@@ -82,35 +120,25 @@ class Core:
                 # Simple notification for new chat - chat title will be retrieved in bot.py if needed
                 notification = f"Bot added to new chat (ID: {self.id})"
                 
-                existing_notifications = self.redis_conn.get('notifications')
-                if existing_notifications is None:
-                    notifications_list = []
-                else:
-                    notifications_list = json.loads(existing_notifications.decode('utf-8'))
+                self.notifications.push({'text': notification, 'recipient': NOTIFIEE_ID, 'kind': NEW_CHAT, 'chat_id': self.id})
                 
-                notifications_list.append([notification, NOTIFIEE_ID])
-                self.redis_conn.set('notifications', json.dumps(notifications_list))
-                self.redis_conn.incrby('pending_notifications', 1)
-                
-                print(f"[CORE] New chat notification queued for chat {self.id}")
+                log.info("New chat notification queued", chat=self.id)
             except Exception as e:
-                print(f"[CORE] Failed to queue new chat notification: {e}")
+                log.error("Failed to queue new chat notification", chat=self.id, error=e)
 
     def _do_checks(self, uid, req_interval) -> tuple[bool, str]:
         # check if group ok
         if req_interval is None:
             # Get default interval for fallback check
-            default_interval_result = self.cursor.execute("SELECT interval FROM prices WHERE id = 0").fetchone()
-            default_interval_seconds = default_interval_result[0] * 60 if default_interval_result else 86400
+            default_interval_seconds = self.catalog.default_interval() * 60
             
             if (bool(self.active) and time.time() >= self.last + self.interval) or time.time() > self.last + default_interval_seconds:
                 return True, "group"
 
         # check user ok
-        print(f"[CORE] Checking user permissions for user {uid}")
+        log.debug("Checking user permissions", chat=self.id, user=uid)
         self.ensure_user(uid)
-        print("Ensured user")
-        user_data = self.cursor.execute('SELECT paying, last, interval FROM users WHERE id = ?', (uid,)).fetchone()
+        user_data = self.db.fetchone('SELECT paying, last, interval FROM users WHERE id = ?', (uid,))
         paying, last, interval = user_data
 
         if not paying:
@@ -121,30 +149,42 @@ class Core:
 
         return False, ""
 
+    def _flush_ingest(self):
+        # Buffered messages must be committed before the window is read; if the
+        # writer is stuck, read what is committed rather than hang the request
+        if self.ingest is not None and not self.ingest.flush():
+            log.warning("Message buffer not flushed in time, reading committed messages", chat=self.id)
+
+    def _get_message_rows(self, from_t):
+        self._flush_ingest()
+        return self.store.window(self.id, from_t, 'time, user, text, id, reply')
+
+    @staticmethod
+    def _format_messages(rows):
+        return transcript.format_rows(rows)
+
     def _get_messages(self, interval):
-        # return a string in the format "user: text\n" for messages in the interval time window
+        # return the compact transcript (legend, lines) of the messages in the interval time window
         from_t = int(time.time()) - interval
 
-        msgs = self.cursor.execute('SELECT user, text FROM messages WHERE chat_id = ? AND time > ?', (self.id, from_t)).fetchall()
-        msgs = '\n'.join(f'{x[0]}: {x[1]}' for x in msgs)
+        with metrics.GET_MESSAGES_SECONDS.time():
+            return transcript.build(self._get_message_rows(from_t))
 
-        return msgs
-
-    def summ(self, uid, interval=None) -> bool:
-        print(f"[CORE] Summary request from user {uid} in chat {self.id}")
+    def summ(self, uid, interval=None):
+        log.info("Summary request", chat=self.id, user=uid)
+        # Cached cores outlive payments and billing runs; check against the current row
+        self.update()
         ok, funder = self._do_checks(uid, interval)
         basic_interval = 0
 
         if not ok:
-            print(f"[CORE] Summary request denied for user {uid} in chat {self.id}")
+            log.info("Summary request denied", chat=self.id, user=uid)
             return False
 
         # handle timeout logic
         if funder == "user":
-            self.cursor.execute('UPDATE users SET last = ? WHERE id = ?', (int(time.time()), uid))
-            basic_interval = self.cursor.execute('SELECT interval FROM users WHERE id = ?', (uid,)).fetchone()[0]
+            basic_interval = self.db.fetchone('SELECT interval FROM users WHERE id = ?', (uid,))[0]
         elif funder == "group":
-            self.last = int(time.time())
             interval = self.interval
         else:
             raise ValueError
@@ -152,20 +192,155 @@ class Core:
         if interval is None:
             interval = basic_interval
 
-        self._request_summ(interval)
-        self._push()
+        # Paid tiers and paying users are served ahead of free traffic
+        ticket = self._request_summ(interval, self.queues[queue_for(self.tier, self.active, funder)])
 
-        return True
+        if ticket.attached:
+            # The pending summary is delivered to this chat anyway; nothing new was spent
+            return ticket
+
+        # Only consume the cooldown once the job is queued
+        with self.db.transaction():
+            if funder == "user":
+                self.db.execute('UPDATE users SET last = ? WHERE id = ?', (int(time.time()), uid))
+            else:
+                self.last = int(time.time())
+            self._push()
+
+        return ticket
+
+    def _fingerprint(self, interval):
+        # Same newest message and count in the window means the same message set
+        from_t = int(time.time()) - interval
+        self._flush_ingest()
+
+        count, last_id = self.store.window_stats(self.id, from_t)
+        return fingerprint(self.id, last_id, count, get_summary_cache().prompt_digest())
+
+    def _request_summ(self, interval, queue):
+        key = self._fingerprint(interval)
+        cached = get_summary_cache().get(key)
+        if cached is not None:
+            log.info("Window unchanged, delivering cached summary", chat=self.id)
+            self.summaries.push({'gid': self.id, 'summary': cached, 'fingerprint': key})
+            return SummaryTicket(None, cached=True)
+
+        # One LLM run per window: later requests attach to the job already summarizing it
+        inflight = INFLIGHT_KEY.format(self.id, key)
+        job_id = uuid.uuid4().hex
+        owner = self._claim_inflight(inflight, job_id)
+        if owner is not None:
+            log.info("Summary already in flight, attaching", chat=self.id, job=owner)
+            return SummaryTicket(owner, attached=True)
+
+        stream = SummaryStream(new_stream_key(self.id), self.redis_conn) if STREAM_SUMMARIES else None
+        meta = {'stream_key': stream.key if stream else None, 'fingerprint': key, 'inflight': inflight, 'requested_at': time.time()}
+
+        try:
+            queued = self._enqueue_summ(interval, queue, meta, job_id)
+        except Exception:
+            self.redis_conn.delete(inflight)
+            raise
+
+        return SummaryTicket(queued.id, stream)
+
+    def _claim_inflight(self, key, job_id):
+        """
+        Mark job_id as the summary in flight for a window.
+
+        Returns:
+            id of the live job already summarizing the window, or None if job_id may run
+        """
+        for _ in range(2):
+            if self.redis_conn.set(key, job_id, nx=True, ex=INFLIGHT_TTL):
+                return None
+
+            owner = self.redis_conn.get(key)
+            if owner is None:
+                continue
+            try:
+                status = Job.fetch(owner.decode(), connection=self.redis_conn).get_status()
+            except NoSuchJobError:
+                status = None
+            if status in LIVE_STATUSES:
+                return owner.decode()
+
+            # The previous run finished, failed or expired without releasing the window; take its place
+            self.redis_conn.delete(key)
+
+        return None
+
+    def _enqueue_summ(self, interval, queue, meta, job_id):
+        # Long windows reuse cached summaries of their closed buckets
+        if rolling.BUCKET_SECONDS and interval >= 2 * rolling.BUCKET_SECONDS:
+            queued = self._request_rolling_summ(interval, meta, queue, job_id)
+            if queued is not None:
+                return queued
 
-    def _request_summ(self, interval):
         # get messages
-        messages = self._get_messages(interval)
-        print(f"[CORE] Enqueuing summary job for chat {self.id} with {len(messages)} chars")
-        self.rq.enqueue(job, messages, self.id)
+        legend, lines = self._get_messages(interval)
+        log.info("Enqueuing summary job", chat=self.id, job=job_id, queue=queue.name, lines=len(lines))
+
+        # Every chunk carries the legend so map jobs can resolve the aliases. A legend
+        # of a huge crowd may not leave room for lines; chunks then run over instead
+        budget = max(CHUNK_TOKENS - estimate_tokens(legend), MIN_CHUNK_TOKENS)
+        chunks = [f'{legend}\n{chunk}' if legend else chunk for chunk in split_chunks(lines, budget)]
+        if len(chunks) <= 1:
+            queued = queue.enqueue(job, chunks[0] if chunks else '', self.id, meta, job_id=job_id)
+        else:
+            log.info("Splitting summary into chunks", chat=self.id, job=job_id, chunks=len(chunks))
+            maps = queue.enqueue_many([
+                rq.Queue.prepare_data(map_job, (chunk, self.id, i, len(chunks)), result_ttl=MAP_RESULT_TTL)
+                for i, chunk in enumerate(chunks)
+            ])
+            # Reduce over whatever chunks succeeded rather than stalling on one failure
+            queued = queue.enqueue(reduce_job, self.id, [m.id for m in maps], meta, depends_on=Dependency(jobs=maps, allow_failure=True), job_id=job_id)
+
+        return queued
+
+    def _request_rolling_summ(self, interval, meta, queue, job_id=None):
+        now = int(time.time())
+        from_t = now - interval
+
+        buckets = rolling.closed_buckets(from_t, now)
+        if not buckets:
+            return None
+
+        rows = self._get_message_rows(from_t)
+        cached = dict(self.db.fetchall('SELECT bucket, summary FROM bucket_summaries WHERE chat_id = ? AND bucket >= ? AND bucket <= ?', (self.id, buckets[0], buckets[-1])))
+
+        segments = rolling.plan(rows, from_t, now, cached)
+        if not segments:
+            return None
+
+        for segment in segments:
+            if segment[0] != rolling.SUMMARY:
+                segment[2] = self._format_messages(segment[2])
+
+        # Every request must fit CHUNK_TOKENS: a bucket too busy to summarize in one go, or raw
+        # messages and cached summaries too long for the final prompt, go through map-reduce instead
+        oversized = [segment[1] for segment in segments if segment[0] == rolling.JOB and estimate_tokens(segment[2]) > CHUNK_TOKENS]
+        prompt_tokens = sum(estimate_tokens(segment[2]) for segment in segments if segment[0] != rolling.JOB)
+        if oversized or prompt_tokens > CHUNK_TOKENS:
+            log.info("Window too large for a rolling summary, using map-reduce", chat=self.id, job=job_id, oversized_buckets=len(oversized), prompt_tokens=prompt_tokens)
+            return None
+
+        # Summarize closed buckets missing from the cache; bucket_job stores them for later requests
+        pending = [segment for segment in segments if segment[0] == rolling.JOB]
+        jobs = queue.enqueue_many([
+            rq.Queue.prepare_data(bucket_job, (segment[2], self.id, segment[1]), result_ttl=MAP_RESULT_TTL)
+            for segment in pending
+        ]) if pending else []
+
+        for segment, bucket_j in zip(pending, jobs):
+            segment[2] = bucket_j.id
+
+        log.info("Enqueuing rolling summary", chat=self.id, job=job_id, queue=queue.name, cached_buckets=len(cached), new_buckets=len(jobs))
+        return queue.enqueue(rolling_job, self.id, segments, meta, depends_on=Dependency(jobs=jobs, allow_failure=True) if jobs else None, job_id=job_id)
 
     def update_summary(self, summary):
         self.summary = summary
-        self._push()
+        self.db.execute('UPDATE chats SET summ = ? WHERE id = ?', (summary, self.id))
 
     def get_summary(self):
         self.update()
@@ -173,40 +348,34 @@ class Core:
 
     def get_status(self):
         self.update()
-        status = self.cursor.execute("SELECT interval, balance, payed_date, active, tier FROM chats WHERE id = ?", (self.id,)).fetchone()
+        status = self.db.fetchone("SELECT interval, balance, payed_date, active, tier FROM chats WHERE id = ?", (self.id,))
         return status
 
     def new_message(self, mid, uid, timestamp, text, username, reply: int = 0):
-        print(f"[CORE] Storing message from user {uid} in chat {self.id}")
-        self.cursor.execute('INSERT INTO messages (id, uid, chat_id, text, time, user, reply) VALUES (?, ?, ?, ?, ?, ?, ?)', (mid, uid, self.id, text, timestamp, username, reply))
-        self.conn.commit()
+        log.sampled("Storing message", chat=self.id, user=uid)
+        if self.ingest is not None:
+            self.ingest.put(mid, uid, self.id, text, timestamp, username, reply)
+            return
+
+        self.store.insert_many([(mid, uid, self.id, text, timestamp, username, reply)])
 
     @staticmethod
     def ensure_user(uid):
-        dotenv.load_dotenv()
-        path = os.getenv('SQL_PATH')
-
-        new_conn = sqlite3.connect(path)
-        new_cursor = new_conn.cursor()
+        db = get_db()
 
-        user_exists = new_cursor.execute("SELECT paying FROM users WHERE id = ?", (uid,)).fetchone() is not None
+        user_exists = db.fetchone("SELECT paying FROM users WHERE id = ?", (uid,)) is not None
 
         if user_exists:
-            new_conn.close()
             return
 
-        # Get default interval from database
-        default_interval_result = new_cursor.execute("SELECT interval FROM prices WHERE id = 0").fetchone()
-        default_interval_minutes = default_interval_result[0] if default_interval_result else 1440
+        default_interval_minutes = get_catalog().default_interval()
         
-        print(f"[CORE] Creating new user {uid} with default settings")
-        new_cursor.execute('INSERT INTO users (id, paying, last, interval) VALUES (?, ?, ?, ?)', (uid, 0, 0, default_interval_minutes * 60))
-        new_conn.commit()
-        new_conn.close()
+        log.info("Creating new user with default settings", user=uid)
+        db.execute('INSERT INTO users (id, paying, last, interval) VALUES (?, ?, ?, ?)', (uid, 0, 0, default_interval_minutes * 60))
 
     def close(self):
-        if self.conn:
-            self.conn.close()
+        if self.redis_conn:
+            self.redis_conn.close()
 
 
 
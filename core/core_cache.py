@@ -0,0 +1,98 @@
+"""
+Bounded LRU cache of per-chat Core objects.
+"""
+import collections
+import os
+import threading
+import time
+
+from core.log import get_logger
+
+log = get_logger('cache')
+
+
+class CoreCache:
+    def __init__(self, factory, max_size=None, max_idle=None):
+        self.factory = factory
+        self.max_size = int(max_size or os.getenv('CORE_CACHE_SIZE', 1024))
+        self.max_idle = int(max_idle or os.getenv('CORE_CACHE_IDLE', 3600))
+
+        # gid -> (core, last used); least recently used first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, gid):
+        with self.lock:
+            entry = self.entries.get(gid)
+            if entry is not None:
+                self.entries[gid] = (entry[0], time.monotonic())
+                self.entries.move_to_end(gid)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # Build outside the lock so a slow load does not block other chats
+        core = self.factory(gid)
+
+        with self.lock:
+            entry = self.entries.get(gid)
+            if entry is not None:
+                # Another thread loaded the same chat meanwhile; keep theirs
+                evicted = [core]
+                core = entry[0]
+            else:
+                self.entries[gid] = (core, time.monotonic())
+                evicted = self._evict()
+
+        self._close(evicted)
+        return core
+
+    def _evict(self):
+        """Pop idle entries and entries over capacity, oldest first. Caller holds the lock"""
+        evicted = []
+        cutoff = time.monotonic() - self.max_idle
+
+        while self.entries:
+            gid, (core, last_used) = next(iter(self.entries.items()))
+            if len(self.entries) <= self.max_size and last_used >= cutoff:
+                break
+            del self.entries[gid]
+            evicted.append(core)
+
+        self.evictions += len(evicted)
+        return evicted
+
+    def sweep(self):
+        """Evict cores that have been idle for longer than max_idle"""
+        with self.lock:
+            evicted = self._evict()
+        self._close(evicted)
+        return len(evicted)
+
+    @staticmethod
+    def _close(cores):
+        for core in cores:
+            try:
+                core.close()
+            except Exception as e:
+                log.warning("Failed to close core", chat=core.id, error=e)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def close(self):
+        with self.lock:
+            evicted = [core for core, _ in self.entries.values()]
+            self.entries.clear()
+        self._close(evicted)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, gid):
+        return gid in self.entries
@@ -0,0 +1,121 @@
+"""
+Shared SQLite data-access layer.
+
+A process-wide Database hands out pooled connections: each thread borrows one
+for the duration of a call or transaction and returns it afterwards, so the
+number of open connections is bounded no matter how many chats or threads the
+bot serves. Long-lived connections also keep sqlite3's per-connection prepared
+statement cache warm across calls.
+"""
+import contextlib
+import os
+import queue
+import sqlite3
+import threading
+
+import dotenv
+
+from core import metrics
+
+
+class Database:
+    def __init__(self, path=None, max_connections=None, cached_statements=256, timeout=30):
+        dotenv.load_dotenv()
+        self.path = path or os.getenv('SQL_PATH')
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(int(max_connections or os.getenv('SQL_POOL_SIZE', 8)))
+        self._local = threading.local()
+
+    def _connect(self):
+        # Connections move between threads through the pool, but only one thread uses each at a time
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, cached_statements=self.cached_statements)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection for the current thread; nested calls reuse the same one"""
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+
+        self._slots.acquire()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._slots.release()
+                raise
+
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            # Never hand an open transaction to the next borrower
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+            self._slots.release()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run the enclosed statements in one transaction; nested transactions join the outer one"""
+        with self.connection() as conn:
+            if getattr(self._local, 'in_transaction', False):
+                yield conn
+                return
+
+            self._local.in_transaction = True
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._local.in_transaction = False
+
+    def fetchone(self, sql, params=()):
+        with metrics.SQL_SECONDS.time(op='fetchone'), self.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        with metrics.SQL_SECONDS.time(op='fetchall'), self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def execute(self, sql, params=()):
+        """Run a write statement, committing unless inside a transaction. Returns the row count"""
+        with metrics.SQL_SECONDS.time(op='execute'), self.transaction() as conn:
+            return conn.execute(sql, params).rowcount
+
+    def executemany(self, sql, rows):
+        with metrics.SQL_SECONDS.time(op='executemany'), self.transaction() as conn:
+            return conn.executemany(sql, rows).rowcount
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def get_db():
+    """Process-wide Database for SQL_PATH"""
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = Database()
+    return _db
@@ -0,0 +1,80 @@
+"""
+Redis-backed delivery queues shared by producers (LLM worker, Core) and the bot.
+
+Entries are pushed to the head of a Redis list and popped from its tail with
+BLMOVE into a per-queue processing list, so a consumer wakes up as soon as an
+entry arrives and nothing is lost if it dies before acknowledging delivery.
+"""
+import json
+import os
+import time
+
+import redis
+
+SUMMARIES = 'summaries'
+NOTIFICATIONS = 'notifications'
+
+MAX_ATTEMPTS = 3
+
+
+class DeliveryItem:
+    """Entry popped from a DeliveryQueue, pending acknowledgement"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.payload = json.loads(raw)
+
+    @property
+    def attempts(self):
+        return self.payload.get('attempts', 0)
+
+
+class DeliveryQueue:
+    def __init__(self, name, redis_conn=None):
+        self.name = name
+        self.redis_conn = redis_conn if redis_conn is not None else redis.Redis(host=os.getenv('REDIS_HOST'))
+        self.key = f'delivery:{name}'
+        self.processing_key = f'delivery:{name}:processing'
+
+    def push(self, payload):
+        # queued_at lets consumers measure delivery lag
+        self.redis_conn.lpush(self.key, json.dumps(dict(payload, queued_at=time.time())))
+
+    def pop(self, timeout=5):
+        """
+        Block for up to `timeout` seconds waiting for an entry.
+
+        Returns:
+            DeliveryItem, or None if the timeout expired
+        """
+        raw = self.redis_conn.blmove(self.key, self.processing_key, timeout, 'RIGHT', 'LEFT')
+        if raw is None:
+            return None
+
+        return DeliveryItem(raw)
+
+    def ack(self, item):
+        self.redis_conn.lrem(self.processing_key, 1, item.raw)
+
+    def retry(self, item):
+        """Put an entry back at the front of the queue, dropping it after MAX_ATTEMPTS"""
+        payload = dict(item.payload, attempts=item.attempts + 1)
+
+        pipe = self.redis_conn.pipeline()
+        pipe.lrem(self.processing_key, 1, item.raw)
+        if payload['attempts'] < MAX_ATTEMPTS:
+            pipe.rpush(self.key, json.dumps(payload))
+        pipe.execute()
+
+        return payload['attempts'] < MAX_ATTEMPTS
+
+    def recover(self):
+        """Move entries left unacknowledged by a previous consumer back onto the queue"""
+        moved = 0
+        while self.redis_conn.lmove(self.processing_key, self.key, 'LEFT', 'RIGHT') is not None:
+            moved += 1
+
+        return moved
+
+    def __len__(self):
+        return self.redis_conn.llen(self.key)
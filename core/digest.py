@@ -0,0 +1,103 @@
+"""
+Coalesced admin notifications.
+
+Routine admin events (summary deliveries, new chats) are counted and sent to
+the notifiee as one digest every DIGEST_INTERVAL seconds, with the busiest
+chats listed, instead of one Telegram message each. Critical events (payments,
+tier changes, dropped deliveries, failed summary jobs) skip the buffer and are
+sent right away. DIGEST_INTERVAL=0 sends every event as it happens.
+"""
+import collections
+import os
+import threading
+
+import dotenv
+
+from core.log import get_logger
+
+dotenv.load_dotenv()
+DIGEST_INTERVAL = int(os.getenv('DIGEST_INTERVAL', 300))
+DIGEST_TOP = int(os.getenv('DIGEST_TOP', 5))
+
+log = get_logger('digest')
+
+# Event kinds and how they are titled in the digest
+SUMMARY = 'summary'
+NEW_CHAT = 'new_chat'
+TITLES = {
+    SUMMARY: 'Summaries delivered',
+    NEW_CHAT: 'New chats',
+}
+
+
+class NotificationDigest:
+    def __init__(self, send, interval=None, top=None):
+        """
+        Args:
+            send: callable taking the text of one admin message
+        """
+        self.send = send
+        self.interval = DIGEST_INTERVAL if interval is None else interval
+        self.top = top or DIGEST_TOP
+
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.chats = collections.Counter()
+        self.labels = {}
+        self.stopped = threading.Event()
+
+    def add(self, kind, text, chat_id=None, label=None):
+        """Record a routine event; `text` is what is sent when digests are disabled"""
+        if not self.interval:
+            self.send(text)
+            return
+
+        with self.lock:
+            self.counts[kind] += 1
+            if chat_id is not None:
+                self.chats[chat_id] += 1
+                if label:
+                    self.labels[chat_id] = label
+
+    def critical(self, text):
+        """Send an event immediately, bypassing the digest"""
+        self.send(text)
+
+    def render(self):
+        """Take the buffered events as digest text, or None if there were none"""
+        with self.lock:
+            counts, chats, labels = self.counts, self.chats, self.labels
+            self.counts, self.chats, self.labels = collections.Counter(), collections.Counter(), {}
+
+        if not counts:
+            return None
+
+        lines = [f"Digest for the last {self.interval // 60 or 1} min"]
+        for kind, count in counts.most_common():
+            lines.append(f"{TITLES.get(kind, kind)}: {count}")
+
+        if chats:
+            lines.append("Most active chats:")
+            for chat_id, count in chats.most_common(self.top):
+                lines.append(f"  {labels.get(chat_id, 'Chat')} (ID: {chat_id}): {count}")
+            if len(chats) > self.top:
+                lines.append(f"  ...and {len(chats) - self.top} more")
+
+        return '\n'.join(lines)
+
+    def flush(self):
+        text = self.render()
+        if text is not None:
+            self.send(text)
+
+    def run(self):
+        """Send a digest every interval until closed"""
+        while not self.stopped.wait(self.interval or 60):
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("Failed to send digest", error=e)
+
+    def close(self):
+        self.stopped.set()
+        self.flush()
@@ -0,0 +1,119 @@
+"""
+Write-behind buffer for incoming chat messages.
+
+Messages from every chat are queued in memory and written by a single
+background thread with executemany, one transaction per batch, instead of
+one INSERT and commit per Telegram message.
+"""
+import os
+import queue
+import threading
+import time
+
+from core.partitions import get_message_store
+from core.log import get_logger
+
+log = get_logger('ingest')
+
+_STOP = object()
+
+
+class MessageBuffer:
+    def __init__(self, store=None, flush_ms=None, batch_size=None, max_pending=None):
+        self.store = store if store is not None else get_message_store()
+        self.flush_interval = int(flush_ms or os.getenv('INGEST_FLUSH_MS', 50)) / 1000
+        self.batch_size = int(batch_size or os.getenv('INGEST_BATCH_SIZE', 500))
+        self.flush_timeout = float(os.getenv('INGEST_FLUSH_TIMEOUT', 5))
+
+        # Bounded so a stalled database applies backpressure instead of growing memory
+        self.pending = queue.Queue(maxsize=int(max_pending or os.getenv('INGEST_MAX_PENDING', 10000)))
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._run, name='message-buffer', daemon=True)
+        self.thread.start()
+
+    def put(self, mid, uid, chat_id, text, timestamp, username, reply=0):
+        if self.closed:
+            raise RuntimeError("MessageBuffer is closed")
+        self.pending.put((mid, uid, chat_id, text, timestamp, username, reply))
+
+    def flush(self, timeout=None):
+        """
+        Block until every message queued before this call has been committed,
+        for at most `timeout` seconds (default INGEST_FLUSH_TIMEOUT).
+
+        Returns:
+            False if the timeout expired first
+        """
+        if self.closed:
+            return True
+
+        timeout = self.flush_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        done = threading.Event()
+        try:
+            self.pending.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(max(deadline - time.monotonic(), 0))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(_STOP)
+        self.thread.join()
+
+    def _run(self):
+        running = True
+
+        while running:
+            rows, barriers = [], []
+            item = self.pending.get()
+            deadline = time.monotonic() + self.flush_interval
+
+            # Collect until the batch is full, the interval elapses or someone waits on a flush
+            while True:
+                if item is _STOP:
+                    running = False
+                    break
+                elif isinstance(item, threading.Event):
+                    barriers.append(item)
+                    break
+                else:
+                    rows.append(item)
+
+                if len(rows) >= self.batch_size:
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+            try:
+                if rows:
+                    self._write(rows)
+            except Exception as e:
+                # Never let one batch stop the writer; later messages still need it
+                log.error("Dropping batch", rows=len(rows), error=e)
+            finally:
+                for barrier in barriers:
+                    barrier.set()
+
+    def _write(self, rows):
+        try:
+            self.store.insert_many(rows)
+            return
+        except Exception as e:
+            log.warning("Batch insert failed, retrying row by row", rows=len(rows), error=e)
+
+        # Isolate the offending rows so one bad message does not drop the whole batch
+        for row in rows:
+            try:
+                self.store.insert_many([row])
+            except Exception as e:
+                log.error("Dropping message", message=row[0], chat=row[2], error=e)
@@ -1,59 +1,228 @@
 import os
+import threading
+import time
+
 import redis
-import json
 import httpx
-import dotenv
-import os
 from openai import OpenAI
+from rq import get_current_job
+from rq.job import Job
 from dotenv import load_dotenv
 
+from core.delivery import DeliveryQueue, SUMMARIES, NOTIFICATIONS
+from core.streaming import SummaryStream
+from core.db import get_db
+from core import rolling
+from core import metrics
+from core.log import get_logger
+
+log = get_logger('llm')
+
 # Load environment variables from .env file
 load_dotenv()
 
 
-def job(prompt, gid):
-    print(f"[LLM] Starting summary job for chat {gid}")
-    print(f"[LLM] Prompt length: {len(prompt)} characters")
-
-    dotenv.load_dotenv()
-    proxy_url = os.getenv('PROXY_URL')
-    http_client = httpx.Client(proxy=proxy_url)
-
-    model = os.getenv('OPENAI_MODEL')
-    
-    client = OpenAI(api_key=os.getenv('OPENAI_KEY'), http_client=http_client)
-    print(f"[LLM] OpenAI client initialized")
-
-    with open(os.getenv('PROMPT_PATH'), 'r') as f:
-        instructions = f.read()
-    print(f"[LLM] Loaded prompt instructions ({len(instructions)} chars)")
-    print(f"[LLM] Loaded context instructions ({len(prompt)} chars)")
-
-    print(f"[LLM] Sending request to OpenAI API...")
-    response = client.responses.create(
-        model=model,
-        instructions=instructions,
-        input=prompt
-    )
-    print(f"[LLM] Received response from OpenAI")
-
-    out = response.output_text
-    print(f"[LLM] Generated summary ({len(out)} chars) for chat {gid}")
-    
-    redis_conn = redis.Redis(host=os.getenv('REDIS_HOST'))
-    print(f"[LLM] Connected to Redis, storing results...")
-
-    redis_conn.incrby('pending', 1)
-    
-    # Get existing summaries list or initialize empty list
-    existing_summaries = redis_conn.get('summaries')
-    if existing_summaries is None:
-        summaries_list = []
-    else:
-        summaries_list = json.loads(existing_summaries.decode('utf-8'))
-    
-    # Append new summary and save back
-    summaries_list.append([out, gid])
-    redis_conn.set('summaries', json.dumps(summaries_list))
-    print(f"[LLM] Summary stored in Redis queue for chat {gid}")
+class PromptCache:
+    """Prompt file contents, re-read only when the file's mtime changes"""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.text = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    with open(self.path, 'r') as f:
+                        self.text = f.read()
+                    self.mtime = mtime
+                    log.info("Loaded prompt instructions", path=self.path, chars=len(self.text))
+
+        return self.text
+
+
+class LLMGateway:
+    """Long-lived OpenAI client, prompt and Redis connection shared by every job in a worker process"""
+
+    def __init__(self):
+        load_dotenv()
+        self.model = os.getenv('OPENAI_MODEL')
+
+        # Keep-alive pool so consecutive jobs reuse the TLS/proxy connection
+        self.http_client = httpx.Client(
+            proxy=os.getenv('PROXY_URL'),
+            limits=httpx.Limits(max_connections=int(os.getenv('LLM_MAX_CONNECTIONS', 10)), max_keepalive_connections=int(os.getenv('LLM_MAX_CONNECTIONS', 10)), keepalive_expiry=300),
+        )
+        self.client = OpenAI(api_key=os.getenv('OPENAI_KEY'), http_client=self.http_client)
+        self.prompt = PromptCache(os.getenv('PROMPT_PATH'))
+        # Instructions for merging partial summaries; falls back to the main prompt
+        self.reduce_prompt = PromptCache(os.getenv('REDUCE_PROMPT_PATH')) if os.getenv('REDUCE_PROMPT_PATH') else self.prompt
+
+        self.redis_conn = redis.Redis(host=os.getenv('REDIS_HOST'))
+        self.summaries = DeliveryQueue(SUMMARIES, self.redis_conn)
+        self.notifications = DeliveryQueue(NOTIFICATIONS, self.redis_conn)
+        self.notifiee = int(os.getenv('NOTIFIEE_ID') or 0)
+        log.info("OpenAI client initialized", model=self.model)
+
+    def summarize(self, prompt, on_delta=None, instructions=None):
+        """Summarize `prompt`; if `on_delta` is given, stream the response and feed it each text delta"""
+        mode = 'plain' if on_delta is None else 'stream'
+        start = time.perf_counter()
+        try:
+            with metrics.LLM_SECONDS.time(mode=mode):
+                out = self._summarize(prompt, on_delta, instructions)
+        except Exception as e:
+            metrics.LLM_ERRORS.inc()
+            log.error("OpenAI request failed", mode=mode, job=_job_id(), error=e)
+            raise
+
+        log.timed("OpenAI response received", start, mode=mode, job=_job_id(), prompt_chars=len(prompt), chars=len(out))
+        return out
+
+    def _summarize(self, prompt, on_delta, instructions):
+        if instructions is None:
+            instructions = self.prompt.get()
+
+        log.debug("Sending request to OpenAI API", job=_job_id())
+        if on_delta is None:
+            response = self.client.responses.create(
+                model=self.model,
+                instructions=instructions,
+                input=prompt
+            )
+            return response.output_text
+
+        chunks = []
+        with self.client.responses.create(model=self.model, instructions=instructions, input=prompt, stream=True) as events:
+            for event in events:
+                if event.type == 'response.output_text.delta':
+                    chunks.append(event.delta)
+                    on_delta(event.delta)
+                elif event.type == 'response.completed':
+                    return event.response.output_text
+                elif event.type in ('response.failed', 'error'):
+                    raise RuntimeError(f"OpenAI stream failed: {event.type}")
+
+        return ''.join(chunks)
+
+    def close(self):
+        self.client.close()
+        self.redis_conn.close()
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = LLMGateway()
+    return _gateway
+
+
+def _job_id():
+    current = get_current_job()
+    return current.id if current is not None else None
+
+
+def job(prompt, gid, meta=None):
+    log.info("Starting summary job", chat=gid, job=_job_id(), chars=len(prompt))
+
+    _summarize_and_deliver(get_gateway(), prompt, gid, meta)
+
+
+def map_job(chunk, gid, index, total):
+    """Summarize one chunk of a transcript too large for a single request; the result feeds reduce_job"""
+    log.info("Starting map job", chat=gid, job=_job_id(), part=f"{index + 1}/{total}", chars=len(chunk))
+    return get_gateway().summarize(chunk)
+
+
+def reduce_job(gid, map_job_ids, meta=None):
+    """Merge the partial summaries of the map jobs and deliver the result like a regular job"""
+    gateway = get_gateway()
+
+    partials = [j.return_value() if j is not None else None for j in Job.fetch_many(map_job_ids, connection=gateway.redis_conn)]
+    parts = [p for p in partials if p]
+    if not parts:
+        error = RuntimeError(f"All {len(map_job_ids)} map jobs failed for chat {gid}")
+        _release(gateway, gid, meta or {}, error)
+        raise error
+
+    log.info("Starting reduce job", chat=gid, job=_job_id(), parts=len(parts), expected=len(partials))
+    prompt = '\n\n'.join(f"Part {i + 1}/{len(parts)}:\n{part}" for i, part in enumerate(parts))
+
+    _summarize_and_deliver(gateway, prompt, gid, meta, instructions=gateway.reduce_prompt.get())
+
+
+def bucket_job(text, gid, bucket):
+    """Summarize one closed time bucket and cache the result for later rolling summaries"""
+    log.info("Starting bucket job", chat=gid, job=_job_id(), bucket=bucket, chars=len(text))
+    out = get_gateway().summarize(text)
+
+    get_db().execute('INSERT OR REPLACE INTO bucket_summaries (chat_id, bucket, summary) VALUES (?, ?, ?)', (gid, bucket, out))
+    return out
+
+
+def rolling_job(gid, segments, meta=None):
+    """Summarize a window from cached bucket summaries, fresh bucket_job results and the newest raw messages"""
+    gateway = get_gateway()
+
+    job_ids = [value for kind, _, value in segments if kind == rolling.JOB]
+    results = {j.id: j.return_value() for j in Job.fetch_many(job_ids, connection=gateway.redis_conn) if j is not None}
+
+    parts = []
+    for kind, bucket, value in segments:
+        if kind == rolling.JOB:
+            value = results.get(value)
+        if not value:
+            continue
+
+        if kind == rolling.RAW:
+            parts.append(f"Messages from {rolling.label(bucket).split('-')[0]}:\n{value}")
+        else:
+            parts.append(f"Summary of {rolling.label(bucket)}:\n{value}")
+
+    log.info("Starting rolling summary job", chat=gid, job=_job_id(), segments=len(parts))
+    _summarize_and_deliver(gateway, '\n\n'.join(parts), gid, meta)
+
+
+def _release(gateway, gid, meta, error, stream=None):
+    """After a failed job: show the error on the summary stream, release the window's in-flight marker and alert the notifiee"""
+    if stream is None and meta.get('stream_key'):
+        stream = SummaryStream(meta['stream_key'], gateway.redis_conn)
+    if stream:
+        stream.fail(str(error))
+    if meta.get('inflight'):
+        gateway.redis_conn.delete(meta['inflight'])
+    if gateway.notifiee:
+        # Critical, so the bot sends it right away instead of folding it into the digest
+        gateway.notifications.push({'text': f"Summary job failed for chat (ID: {gid}): {error}", 'recipient': gateway.notifiee, 'critical': True, 'chat_id': gid})
+
+
+def _summarize_and_deliver(gateway, prompt, gid, meta=None, instructions=None):
+    """
+    Summarize and push the result to the bot's delivery queue.
+
+    `meta` is passed through to the delivery payload: 'stream_key' to stream the
+    response, 'fingerprint' to cache the result under, 'inflight' for the marker
+    of the window, released by the bot on delivery or here on failure.
+    """
+    meta = meta or {}
+    stream = SummaryStream(meta['stream_key'], gateway.redis_conn) if meta.get('stream_key') else None
+
+    try:
+        out = gateway.summarize(prompt, on_delta=stream.append if stream else None, instructions=instructions)
+    except Exception as e:
+        _release(gateway, gid, meta, e, stream)
+        raise
 
+    if stream:
+        stream.finish()
+    gateway.summaries.push(dict(meta, gid=gid, summary=out))
+    log.info("Summary queued for delivery", chat=gid, job=_job_id(), chars=len(out))
@@ -0,0 +1,177 @@
+"""
+Structured, non-blocking logging.
+
+Loggers hand records to a bounded in-memory queue; one background thread
+formats them and writes to stdout, so a slow or unbuffered stdout never
+blocks the polling thread or a worker job. Records carry structured fields
+(chat id, job id, duration, ...) rendered as key=value pairs, or as one JSON
+object per line with LOG_FORMAT=json.
+
+Volume is controlled at runtime with `set_level` / `set_sample_rate` (the
+bot's /loglevel admin command, or SIGUSR1 to toggle DEBUG). Per-message events
+go through `sampled`: DEBUG by default, with a LOG_SAMPLE_RATE share promoted
+to INFO. When the queue is full, INFO and DEBUG records are dropped and
+counted, while warnings and errors are written synchronously and never lost.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import signal
+import sys
+import threading
+import time
+
+import dotenv
+
+dotenv.load_dotenv()
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0))
+
+ROOT = 'dnrbot'
+
+_sample_rate = LOG_SAMPLE_RATE
+_setup_lock = threading.Lock()
+_listener = None
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{self.formatTime(record)} {record.levelname} [{record.name.rsplit('.', 1)[-1].upper()}] {record.getMessage()}"
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'logger': record.name.rsplit('.', 1)[-1], 'msg': record.getMessage()}
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that never blocks: low-level records are dropped when the queue is full, errors are written directly"""
+
+    def __init__(self, log_queue, fallback):
+        super().__init__(log_queue)
+        self.fallback = fallback
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.WARNING:
+                self.fallback.handle(record)
+            else:
+                self.dropped += 1
+
+    def prepare(self, record):
+        # Report dropped records on the next one that gets through
+        record = super().prepare(record)
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            record.msg = f"{record.msg} (after dropping {dropped} records)"
+        return record
+
+
+class BlockingStopListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room rather than fail at exit when the queue is full
+        self.queue.put(self._sentinel)
+
+
+def setup(level=None, fmt=None):
+    """Install the queue-backed handler on the package logger; safe to call more than once"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(JsonFormatter() if (fmt or LOG_FORMAT) == 'json' else TextFormatter())
+
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        root = logging.getLogger(ROOT)
+        root.addHandler(DroppingQueueHandler(log_queue, stream))
+        root.setLevel(level or LOG_LEVEL)
+        root.propagate = False
+
+        _listener = BlockingStopListener(log_queue, stream)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, _toggle_debug)
+
+
+def _toggle_debug(*_):
+    root = logging.getLogger(ROOT)
+    set_level(LOG_LEVEL if root.level == logging.DEBUG else 'DEBUG')
+
+
+def set_level(level):
+    """Change the log level of every logger at runtime"""
+    logging.getLogger(ROOT).setLevel(level.upper() if isinstance(level, str) else level)
+    get_logger('log').warning("Log level changed", level=logging.getLevelName(logging.getLogger(ROOT).level))
+
+
+def set_sample_rate(rate):
+    """Share (0-1) of per-message events logged at INFO"""
+    global _sample_rate
+    _sample_rate = rate
+
+
+def get_level():
+    return logging.getLevelName(logging.getLogger(ROOT).level)
+
+
+class Logger:
+    """Thin wrapper over a stdlib logger taking structured fields as keyword arguments"""
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(f'{ROOT}.{name}')
+
+    def _log(self, level, msg, fields, exc_info=None):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, msg, extra={'fields': fields}, exc_info=exc_info, stacklevel=3)
+
+    def debug(self, msg, **fields):
+        self._log(logging.DEBUG, msg, fields)
+
+    def info(self, msg, **fields):
+        self._log(logging.INFO, msg, fields)
+
+    def warning(self, msg, **fields):
+        self._log(logging.WARNING, msg, fields)
+
+    def error(self, msg, exc_info=None, **fields):
+        self._log(logging.ERROR, msg, fields, exc_info)
+
+    def exception(self, msg, **fields):
+        self._log(logging.ERROR, msg, fields, True)
+
+    def sampled(self, msg, **fields):
+        """Per-message events: DEBUG, with a sampled share promoted to INFO"""
+        level = logging.INFO if _sample_rate and random.random() < _sample_rate else logging.DEBUG
+        self._log(level, msg, fields)
+
+    def timed(self, msg, start, **fields):
+        """Log at INFO with the time elapsed since `start` (a time.perf_counter() value)"""
+        self._log(logging.INFO, msg, dict(fields, duration_ms=round((time.perf_counter() - start) * 1000, 1)))
+
+
+def get_logger(name):
+    setup()
+    return Logger(name)
@@ -0,0 +1,195 @@
+"""
+Process metrics in the Prometheus text exposition format.
+
+Counters and histograms are kept in memory and served over HTTP on
+METRICS_PORT (unset: no endpoint), so the bot and the worker can each be
+scraped at http://127.0.0.1:<port>/metrics. Gauges such as queue depths are
+read by callbacks at scrape time. Worker processes started by the supervisor
+serve on the following ports, one each.
+"""
+import contextlib
+import http.server
+import os
+import threading
+import time
+
+import dotenv
+
+from core.log import get_logger
+
+dotenv.load_dotenv()
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT') or 0)
+
+log = get_logger('metrics')
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{_labels(self.label_names, key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts, sum, count]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{_labels(self.label_names + ("le",), key + (bound,))} {cumulative}')
+                lines.append(f'{self.name}_bucket{_labels(self.label_names + ("le",), key + ("+Inf",))} {count}')
+                lines.append(f'{self.name}_sum{_labels(self.label_names, key)} {total}')
+                lines.append(f'{self.name}_count{_labels(self.label_names, key)} {count}')
+        return lines
+
+
+class Gauge:
+    """Gauge read at scrape time from `collect`, which returns {label values tuple: value}"""
+
+    def __init__(self, name, help, collect, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        try:
+            values = self.collect()
+        except Exception as e:
+            log.warning("Failed to collect gauge", gauge=self.name, error=e)
+            return lines
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_labels(self.label_names, key)} {value}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+def gauge(name, help, collect, labels=()):
+    return REGISTRY.register(Gauge(name, help, collect, labels))
+
+
+# Shared instruments; each process only fills the ones it uses
+HANDLER_SECONDS = histogram('bot_handler_seconds', 'Time spent handling an update, by handler', ['handler'])
+HANDLER_ERRORS = counter('bot_handler_errors_total', 'Handlers that raised, by handler', ['handler'])
+GET_MESSAGES_SECONDS = histogram('core_get_messages_seconds', 'Time to read and format the message window of a summary')
+SUMMARY_TURNAROUND_SECONDS = histogram('summary_turnaround_seconds', 'Time from an accepted summary request to its delivery')
+RQ_WAIT_SECONDS = histogram('rq_wait_seconds', 'Time jobs spent queued before a worker started them', ['queue'])
+LLM_SECONDS = histogram('llm_request_seconds', 'OpenAI request duration', ['mode'])
+LLM_ERRORS = counter('llm_errors_total', 'Failed OpenAI requests')
+DELIVERY_LAG_SECONDS = histogram('delivery_lag_seconds', 'Time delivery entries waited in Redis before being popped', ['queue'])
+SQL_SECONDS = histogram('sqlite_statement_seconds', 'SQLite statement duration, by helper', ['op'])
+
+
+def serve(port=None, host=None):
+    """Serve /metrics in a background thread; no-op unless a port is configured"""
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = REGISTRY.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer((host or METRICS_HOST, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+    log.info(f"Serving metrics on http://{host or METRICS_HOST}:{port}/metrics")
+    return httpd
@@ -0,0 +1,183 @@
+"""
+Rate-limit-aware outbound Telegram dispatcher.
+
+Delivery queue entries are handed to a small worker pool. Every Telegram call
+made through `send` first takes a token from a global bucket (Telegram allows
+about 30 messages per second per bot) and from the recipient chat's bucket
+(about one per second in private chats, 20 per minute in groups), so a backlog
+drains at the fastest rate Telegram accepts. A 429 reply pauses all workers for
+its retry_after before the call is retried.
+"""
+import concurrent.futures
+import os
+import threading
+import time
+
+import dotenv
+import redis
+import telebot
+
+from core.delivery import DeliveryQueue
+from core import metrics
+from core.log import get_logger
+
+dotenv.load_dotenv()
+GLOBAL_RATE = float(os.getenv('OUTBOUND_RATE', 30))
+PRIVATE_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', 1))
+GROUP_RATE = float(os.getenv('OUTBOUND_GROUP_RATE', 20 / 60))
+MAX_RETRIES = 5
+TITLE_TTL = 3600
+# Idle per-chat buckets are forgotten after this long
+CHAT_BUCKET_IDLE = 600
+
+log = get_logger('outbound')
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, returning how long to wait before it may be used"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+
+class OutboundDispatcher:
+    def __init__(self, bot, workers=None, global_rate=None):
+        self.bot = bot
+        self.workers = int(workers or os.getenv('OUTBOUND_WORKERS', 4))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='outbound')
+
+        rate = float(global_rate or GLOBAL_RATE)
+        self.bucket = TokenBucket(rate, burst=max(1, int(rate)))
+        self.chats = {}
+        self.lock = threading.Lock()
+        self.paused_until = 0
+
+        self.titles = {}
+
+    def _chat_bucket(self, chat_id):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.chats.get(chat_id)
+            if bucket is None:
+                # Negative ids are groups and channels, which Telegram limits harder
+                bucket = self.chats[chat_id] = TokenBucket(GROUP_RATE if chat_id < 0 else PRIVATE_RATE)
+                if len(self.chats) > 10000:
+                    for key in [key for key, b in self.chats.items() if now - b.updated > CHAT_BUCKET_IDLE]:
+                        del self.chats[key]
+            return bucket
+
+    def _wait_pause(self):
+        while True:
+            wait = self.paused_until - time.monotonic()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def send(self, chat_id, method, *args, **kwargs):
+        """
+        Call a bot method addressed to chat_id within the rate limits,
+        retrying after the delay Telegram asks for on 429 replies.
+        """
+        for attempt in range(MAX_RETRIES):
+            self._chat_bucket(chat_id).acquire()
+            self.bucket.acquire()
+            self._wait_pause()
+
+            try:
+                return method(*args, **kwargs)
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 429 or attempt == MAX_RETRIES - 1:
+                    raise
+                retry_after = e.result_json.get('parameters', {}).get('retry_after', 2 ** attempt)
+                log.warning("Rate limited by Telegram, pausing", chat=chat_id, retry_after=retry_after)
+                # A 429 means the bot as a whole is over the limit, so every worker backs off
+                with self.lock:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def chat_title(self, chat_id):
+        """Title of a chat, cached for TITLE_TTL"""
+        cached = self.titles.get(chat_id)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+
+        chat = self.bot.get_chat(chat_id)
+        title = chat.title or chat.first_name or f"Chat {chat_id}"
+        self.titles[chat_id] = (title, time.monotonic() + TITLE_TTL)
+        return title
+
+    def consume(self, name, deliver, redis_conn, pop_timeout=5, after=None, dropped=None):
+        """
+        Pop delivery queue entries and hand them to the worker pool. At most two
+        entries per worker are taken at a time, so the backlog stays in Redis
+        where it survives a restart.
+
+        `deliver(payload)` sends an entry and is retried if it raises. The entry
+        is acknowledged as soon as it returns, then `after(payload)` does any
+        bookkeeping; a failure there is logged and never sends the entry again.
+        `dropped(payload)` is called for an entry that ran out of attempts.
+        """
+        queue = DeliveryQueue(name, redis_conn)
+
+        recovered = queue.recover()
+        if recovered:
+            log.info("Requeued unacknowledged entries", queue=name, entries=recovered)
+
+        slots = threading.BoundedSemaphore(self.workers * 2)
+
+        def run(item):
+            try:
+                try:
+                    deliver(item.payload)
+                except Exception as e:
+                    log.warning("Failed to deliver entry", queue=name, attempt=item.attempts + 1, error=e)
+                    if not queue.retry(item):
+                        log.error("Dropping entry", queue=name, attempts=item.attempts + 1)
+                        if dropped is not None:
+                            dropped(item.payload)
+                    return
+
+                queue.ack(item)
+                if after is not None:
+                    try:
+                        after(item.payload)
+                    except Exception as e:
+                        log.error("Failed to record delivered entry", queue=name, error=e)
+            finally:
+                slots.release()
+
+        while 1:
+            slots.acquire()
+            try:
+                item = queue.pop(timeout=pop_timeout)
+            except redis.ConnectionError as e:
+                slots.release()
+                log.error("Redis unavailable while polling", queue=name, error=e)
+                time.sleep(pop_timeout)
+                continue
+
+            if item is None:
+                slots.release()
+                continue
+
+            if 'queued_at' in item.payload:
+                metrics.DELIVERY_LAG_SECONDS.observe(time.time() - item.payload['queued_at'], queue=name)
+            self.executor.submit(run, item)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
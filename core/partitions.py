@@ -0,0 +1,175 @@
+"""
+Time-partitioned message storage.
+
+Messages are written to one table per PARTITION_SECONDS slice of time
+(messages_p<slice start>), each with its own (chat_id, time) and time indexes. Window
+reads only touch the partitions overlapping the window, and retention drops
+whole expired partitions instead of running one large DELETE that holds the
+write lock while the bot is inserting. Rows in the partition straddling the
+cutoff, and in the pre-partitioning `messages` table, are deleted in small
+chunks.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import dotenv
+
+from core.db import get_db
+
+dotenv.load_dotenv()
+PARTITION_SECONDS = int(os.getenv('PARTITION_SECONDS', 3600))
+DELETE_CHUNK = 1000
+
+LEGACY = 'messages'
+PARTITION_RE = re.compile(r'^messages_p(\d+)$')
+
+COLUMNS = 'id, uid, chat_id, text, time, user, reply'
+
+# Every partition is created with these; {table} is the partition name
+PARTITION_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS {table} (id INTEGER, uid INTEGER, chat_id INTEGER, text TEXT, time INTEGER, user TEXT, reply INTEGER)',
+    'CREATE INDEX IF NOT EXISTS idx_{table}_chat_time ON {table} (chat_id, time)',
+    'CREATE INDEX IF NOT EXISTS idx_{table}_time ON {table} (time)',
+]
+
+WINDOW_SQL = 'SELECT {columns} FROM {table} WHERE chat_id = ? AND time > ?'
+STATS_SQL = 'SELECT COUNT(*), MAX(id) FROM {table} WHERE chat_id = ? AND time > ?'
+DELETE_SQL = 'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE time < ? LIMIT ?)'
+
+# Per-table queries on the request and retention paths, with sample parameters;
+# schema.check_query_plans runs them against the legacy table and a template partition
+PARTITION_QUERIES = [
+    (WINDOW_SQL.replace('{columns}', 'time, user, text'), (0, 0)),
+    (STATS_SQL, (0, 0)),
+    (DELETE_SQL, (0, 0)),
+]
+
+
+class MessageStore:
+    def __init__(self, db=None):
+        self.db = db if db is not None else get_db()
+        self.lock = threading.Lock()
+        self.partitions = set()
+        self.refresh()
+
+    def refresh(self):
+        """Reload the partition list from the schema"""
+        rows = self.db.fetchall("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'messages_p%'")
+        with self.lock:
+            self.partitions = {int(m.group(1)) for (name,) in rows if (m := PARTITION_RE.match(name))}
+
+    @staticmethod
+    def partition_of(timestamp):
+        return timestamp // PARTITION_SECONDS * PARTITION_SECONDS
+
+    @staticmethod
+    def table(start):
+        return f'messages_p{start}'
+
+    def _ensure(self, start):
+        if start in self.partitions:
+            return
+
+        with self.db.transaction():
+            for statement in PARTITION_SCHEMA:
+                self.db.execute(statement.format(table=self.table(start)))
+
+        with self.lock:
+            self.partitions.add(start)
+
+    def insert_many(self, rows):
+        """Insert (id, uid, chat_id, text, time, user, reply) rows in one transaction"""
+        by_partition = {}
+        for row in rows:
+            by_partition.setdefault(self.partition_of(row[4]), []).append(row)
+
+        for start in by_partition:
+            self._ensure(start)
+
+        with self.db.transaction():
+            for start, partition_rows in by_partition.items():
+                self.db.executemany(f'INSERT INTO {self.table(start)} ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)', partition_rows)
+
+    def _overlapping(self, from_t):
+        """Tables that may hold rows newer than from_t, oldest first"""
+        with self.lock:
+            starts = sorted(start for start in self.partitions if start + PARTITION_SECONDS > from_t)
+        return [LEGACY] + [self.table(start) for start in starts]
+
+    def _read(self, build):
+        try:
+            return build()
+        except sqlite3.OperationalError as e:
+            # A partition was dropped since the list was loaded
+            if 'no such table' not in str(e):
+                raise
+            self.refresh()
+            return build()
+
+    def window(self, chat_id, from_t, columns='time, user, text'):
+        """Rows of a chat newer than from_t, oldest partition first"""
+        def build():
+            tables = self._overlapping(from_t)
+            sql = ' UNION ALL '.join(WINDOW_SQL.format(columns=columns, table=table) for table in tables)
+            return self.db.fetchall(sql, (chat_id, from_t) * len(tables))
+
+        return self._read(build)
+
+    def window_stats(self, chat_id, from_t):
+        """(message count, newest message id) of a chat's window"""
+        def build():
+            tables = self._overlapping(from_t)
+            sql = ' UNION ALL '.join(STATS_SQL.format(table=table) for table in tables)
+            return self.db.fetchall(sql, (chat_id, from_t) * len(tables))
+
+        rows = self._read(build)
+        ids = [last_id for _, last_id in rows if last_id is not None]
+        return sum(count for count, _ in rows), max(ids) if ids else None
+
+    def drop_before(self, cutoff):
+        """
+        Remove messages older than cutoff.
+
+        Returns:
+            (dropped partitions, rows deleted from partially expired tables)
+        """
+        with self.lock:
+            expired = sorted(start for start in self.partitions if start + PARTITION_SECONDS <= cutoff)
+            straddling = [start for start in self.partitions if start < cutoff < start + PARTITION_SECONDS]
+
+        for start in expired:
+            self.db.execute(f'DROP TABLE IF EXISTS {self.table(start)}')
+            with self.lock:
+                self.partitions.discard(start)
+
+        deleted = 0
+        for table in [LEGACY] + [self.table(start) for start in straddling]:
+            deleted += self._delete_chunked(table, cutoff)
+
+        return len(expired), deleted
+
+    def _delete_chunked(self, table, cutoff):
+        deleted = 0
+        while True:
+            # Short transactions so inserts can interleave with the cleanup
+            count = self.db.execute(DELETE_SQL.format(table=table), (cutoff, DELETE_CHUNK))
+            deleted += count
+            if count < DELETE_CHUNK:
+                return deleted
+            time.sleep(0.01)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_message_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = MessageStore()
+    return _store
@@ -0,0 +1,116 @@
+"""
+Priority queues for summary jobs.
+
+Jobs are routed by the chat's tier and by who pays for the request:
+  - high: active PRO and above groups
+  - normal: other active paid groups, and requests funded by a paying user
+  - low: everything else (free tier)
+
+WeightedWorker picks which queue to try first with probability proportional
+to its weight, so paid traffic is served first most of the time while free
+traffic still gets a share and cannot be starved.
+"""
+import os
+import random
+
+import dotenv
+import redis
+from rq import Queue, SimpleWorker
+from rq.utils import now
+
+from core import metrics
+from core.log import get_logger
+
+dotenv.load_dotenv()
+HIGH = 'summaries:high'
+NORMAL = 'summaries:normal'
+LOW = 'summaries:low'
+QUEUES = [HIGH, NORMAL, LOW]
+
+WEIGHTS = {
+    HIGH: int(os.getenv('QUEUE_WEIGHT_HIGH', 6)),
+    NORMAL: int(os.getenv('QUEUE_WEIGHT_NORMAL', 3)),
+    LOW: int(os.getenv('QUEUE_WEIGHT_LOW', 1)),
+}
+
+# Lowest tier served from the high priority queue (PRO)
+HIGH_TIER = 3
+
+WAIT_KEY = 'queue-wait:{}'
+
+log = get_logger('queue')
+
+
+def queue_for(tier, active, funder):
+    """Name of the queue a summary request goes to"""
+    if active and tier >= HIGH_TIER:
+        return HIGH
+    if (active and tier > 0) or funder == 'user':
+        return NORMAL
+    return LOW
+
+
+def weighted_order(names, weights=None):
+    """Queue names in a random order where heavier queues tend to come first"""
+    weights = weights or WEIGHTS
+    remaining, order = list(names), []
+    while remaining:
+        pick = random.choices(remaining, weights=[max(weights.get(name, 1), 1) for name in remaining])[0]
+        remaining.remove(pick)
+        order.append(pick)
+    return order
+
+
+class WeightedWorker(SimpleWorker):
+    """SimpleWorker with weighted fair queue selection that records how long jobs waited"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reorder_queues(None)
+
+    def reorder_queues(self, reference_queue):
+        by_name = {queue.name: queue for queue in self._ordered_queues}
+        self._ordered_queues = [by_name[name] for name in weighted_order(by_name)]
+
+    def execute_job(self, job, queue):
+        if job.enqueued_at is not None:
+            wait = (now() - job.enqueued_at.replace(tzinfo=now().tzinfo)).total_seconds()
+            metrics.RQ_WAIT_SECONDS.observe(wait, queue=queue.name)
+            record_wait(self.connection, queue.name, wait)
+        return super().execute_job(job, queue)
+
+
+def record_wait(redis_conn, name, seconds):
+    try:
+        pipe = redis_conn.pipeline()
+        pipe.hincrby(WAIT_KEY.format(name), 'jobs', 1)
+        pipe.hincrbyfloat(WAIT_KEY.format(name), 'total', seconds)
+        pipe.hset(WAIT_KEY.format(name), 'last', seconds)
+        pipe.execute()
+    except redis.RedisError as e:
+        log.warning("Failed to record wait time", queue=name, error=e)
+
+
+def queue_stats(redis_conn, names=None):
+    """
+    Per-queue stats.
+
+    Returns:
+        {name: {'depth', 'oldest_wait', 'avg_wait', 'last_wait', 'started'}}, waits in seconds
+    """
+    stats = {}
+    for name in names or QUEUES:
+        queue = Queue(name, connection=redis_conn)
+        oldest = queue.get_jobs(0, 1)
+        oldest_wait = (now() - oldest[0].enqueued_at.replace(tzinfo=now().tzinfo)).total_seconds() if oldest and oldest[0].enqueued_at else 0
+
+        wait = redis_conn.hgetall(WAIT_KEY.format(name))
+        jobs = int(wait.get(b'jobs', 0))
+        stats[name] = {
+            'depth': len(queue),
+            'oldest_wait': oldest_wait,
+            'avg_wait': float(wait.get(b'total', 0)) / jobs if jobs else 0,
+            'last_wait': float(wait.get(b'last', 0)),
+            'started': jobs,
+        }
+    return stats
@@ -0,0 +1,78 @@
+"""
+Rolling per-bucket summaries.
+
+A chat's history is cut into fixed buckets of SUMMARY_BUCKET_SECONDS. Once a
+bucket has closed its summary is cached in bucket_summaries, so a request for
+a long window only sends the cached bucket summaries plus the raw messages
+that are not covered by a closed bucket yet.
+
+Off by default (SUMMARY_BUCKET_SECONDS=0). Buckets are summarized when a
+request first needs them, so this only saves work for chats whose requests
+cover the same hours again, e.g. overlapping user windows. Back-to-back group
+windows never share a bucket, and each request would fan out one job per bucket.
+"""
+import datetime
+import os
+
+import dotenv
+
+dotenv.load_dotenv()
+BUCKET_SECONDS = int(os.getenv('SUMMARY_BUCKET_SECONDS', 0))
+
+# Segment kinds of a rolling plan
+SUMMARY = 'summary'
+JOB = 'job'
+RAW = 'raw'
+
+
+def bucket_of(timestamp):
+    return timestamp // BUCKET_SECONDS * BUCKET_SECONDS
+
+
+def closed_buckets(from_t, now):
+    """Start times of the buckets lying entirely inside (from_t, now]"""
+    first = -(-from_t // BUCKET_SECONDS) * BUCKET_SECONDS
+    return list(range(first, bucket_of(now), BUCKET_SECONDS))
+
+
+def plan(rows, from_t, now, cached):
+    """
+    Split a window into segments.
+
+    Args:
+        rows: (time, user, text) message rows of the window, oldest first
+        cached: bucket start -> cached summary
+
+    Returns:
+        Ordered list of [kind, bucket start, rows or summary] segments:
+        SUMMARY for cached buckets, JOB for closed buckets that still need a
+        summary, RAW for messages outside any closed bucket. None if the window
+        has no closed buckets to reuse.
+    """
+    buckets = closed_buckets(from_t, now)
+    if not buckets:
+        return None
+
+    by_bucket = {}
+    for row in rows:
+        by_bucket.setdefault(bucket_of(row[0]), []).append(row)
+
+    head = [row for row in rows if row[0] < buckets[0]]
+    tail = [row for row in rows if row[0] >= buckets[-1] + BUCKET_SECONDS]
+
+    segments = [[RAW, from_t, head]] if head else []
+    for bucket in buckets:
+        if bucket in cached:
+            segments.append([SUMMARY, bucket, cached[bucket]])
+        elif bucket in by_bucket:
+            segments.append([JOB, bucket, by_bucket[bucket]])
+    if tail:
+        segments.append([RAW, buckets[-1] + BUCKET_SECONDS, tail])
+
+    return segments
+
+
+def label(bucket):
+    start = datetime.datetime.fromtimestamp(bucket)
+    end = datetime.datetime.fromtimestamp(bucket + BUCKET_SECONDS)
+    return f"{start.strftime('%H:%M')}-{end.strftime('%H:%M')}"
@@ -0,0 +1,138 @@
+"""
+Asyncio runtime for the bot.
+
+Updates are fetched without blocking the event loop and dispatched to a
+thread pool that runs the regular (synchronous) handlers, so slow SQLite,
+Redis or Telegram calls in one chat no longer stall the others. Updates from
+the same chat are still handled one at a time, in arrival order.
+"""
+import asyncio
+import concurrent.futures
+import os
+import threading
+
+from core.log import get_logger
+
+log = get_logger('runtime')
+
+
+def chat_key(update):
+    """Ordering key of an update: its chat, or the sender for chat-less updates"""
+    for message in (update.message, update.edited_message, update.channel_post):
+        if message is not None:
+            return message.chat.id
+    if update.pre_checkout_query is not None:
+        return update.pre_checkout_query.from_user.id
+    if update.callback_query is not None:
+        return update.callback_query.from_user.id
+    # No ordering constraint for anything else
+    return ('update', update.update_id)
+
+
+class ChatDispatcher:
+    def __init__(self, handle, max_workers=None, max_pending=None):
+        self.handle = handle
+        self.max_pending = int(max_pending or os.getenv('DISPATCH_MAX_PENDING', 1000))
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=int(max_workers or os.getenv('DISPATCH_WORKERS', 16)),
+            thread_name_prefix='handler',
+        )
+
+        self.loop = None
+        self.queues = {}
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.not_full = None
+
+    def start(self, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self.not_full = asyncio.Condition()
+
+    async def dispatch(self, update):
+        """Queue an update, waiting while the dispatcher is at capacity"""
+        async with self.not_full:
+            await self.not_full.wait_for(lambda: self.pending < self.max_pending)
+            self._enqueue(update)
+
+    def submit(self, update):
+        """
+        Queue an update from another thread without waiting.
+
+        Returns:
+            False if the dispatcher is at capacity
+        """
+        with self.lock:
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+
+        self.loop.call_soon_threadsafe(self._enqueue, update, True)
+        return True
+
+    def _enqueue(self, update, reserved=False):
+        if not reserved:
+            with self.lock:
+                self.pending += 1
+
+        key = chat_key(update)
+        queue = self.queues.get(key)
+        if queue is not None:
+            queue.append(update)
+            return
+
+        # First update for this chat: start a drainer that handles its updates in order
+        self.queues[key] = [update]
+        self.loop.create_task(self._drain(key))
+
+    async def _drain(self, key):
+        queue = self.queues[key]
+        while queue:
+            update = queue.pop(0)
+            try:
+                await self.loop.run_in_executor(self.executor, self.handle, update)
+            except Exception as e:
+                log.error("Handler failed", update=update.update_id, error=e)
+            finally:
+                with self.lock:
+                    self.pending -= 1
+                async with self.not_full:
+                    self.not_full.notify_all()
+
+        del self.queues[key]
+
+    async def join(self):
+        """Wait until every queued update has been handled"""
+        async with self.not_full:
+            await self.not_full.wait_for(lambda: self.pending == 0)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+async def poll_updates(bot, dispatcher, timeout=30):
+    """Long-poll Telegram in a worker thread and feed the updates to the dispatcher"""
+    offset = None
+    while True:
+        try:
+            updates = await asyncio.to_thread(bot.get_updates, offset=offset, timeout=timeout, long_polling_timeout=timeout)
+        except Exception as e:
+            log.warning("Failed to fetch updates", error=e)
+            await asyncio.sleep(1)
+            continue
+
+        for update in updates:
+            offset = update.update_id + 1
+            await dispatcher.dispatch(update)
+
+
+def run_async(bot, timeout=30):
+    """Run the bot with concurrent, per-chat ordered update handling until interrupted"""
+    async def main():
+        dispatcher = ChatDispatcher(lambda update: bot.process_new_updates([update]))
+        dispatcher.start()
+        try:
+            await poll_updates(bot, dispatcher, timeout)
+        finally:
+            dispatcher.close()
+
+    asyncio.run(main())
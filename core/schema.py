@@ -0,0 +1,150 @@
+"""
+Versioned SQLite schema migrations and a query-plan self-check.
+
+The schema version is tracked in PRAGMA user_version. Each migration runs in
+its own transaction and is only applied once, so `migrate()` is safe to call
+on every bot and worker startup. A migration step is a SQL statement or a
+callable taking the connection, for steps that depend on the existing schema.
+"""
+from core.db import get_db
+from core.log import get_logger
+from core.partitions import LEGACY, PARTITION_QUERIES, PARTITION_SCHEMA
+
+log = get_logger('schema')
+
+
+class SchemaError(Exception):
+    pass
+
+
+def _id_index(table):
+    """
+    Index `table` (id) only if id is not its primary key. Tables created by
+    migration 1 look ids up by rowid already, and a second B-tree would only
+    slow their writes; tables from before migrations may have no key at all.
+    """
+    def step(conn):
+        if any(row[5] for row in conn.execute(f'PRAGMA table_info({table})')):
+            conn.execute(f'DROP INDEX IF EXISTS idx_{table}_id')
+        else:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_id ON {table} (id)')
+    return step
+
+
+MIGRATIONS = [
+    # 1: base tables, as the bot has always used them
+    [
+        'CREATE TABLE IF NOT EXISTS chats (id INTEGER PRIMARY KEY, interval INTEGER, last INTEGER, summ TEXT, balance INTEGER, payed_date INTEGER, active INTEGER, tier INTEGER)',
+        'CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, paying INTEGER, last INTEGER, interval INTEGER)',
+        'CREATE TABLE IF NOT EXISTS messages (id INTEGER, uid INTEGER, chat_id INTEGER, text TEXT, time INTEGER, user TEXT, reply INTEGER)',
+        'CREATE TABLE IF NOT EXISTS prices (id INTEGER PRIMARY KEY, price INTEGER, interval INTEGER)',
+        # Seed default tiers (interval in minutes) on a fresh database only
+        '''INSERT INTO prices (id, price, interval)
+           SELECT * FROM (VALUES (0, 0, 1440), (1, 250, 180), (2, 500, 60), (3, 1000, 15), (4, 2000, 15), (5, 2000, 15))
+           WHERE NOT EXISTS (SELECT 1 FROM prices)''',
+    ],
+    # 2: indexes for the hot lookups; databases created before migrations may lack primary keys
+    [
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_time ON messages (chat_id, time)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_time ON messages (time)',
+        _id_index('chats'),
+        _id_index('users'),
+        _id_index('prices'),
+    ],
+    # 3: version stamp bumped on every prices change, polled by the in-memory price catalog
+    [
+        'CREATE TABLE IF NOT EXISTS catalog_version (version INTEGER NOT NULL)',
+        'INSERT INTO catalog_version (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM catalog_version)',
+        'CREATE TRIGGER IF NOT EXISTS prices_version_insert AFTER INSERT ON prices BEGIN UPDATE catalog_version SET version = version + 1; END',
+        'CREATE TRIGGER IF NOT EXISTS prices_version_update AFTER UPDATE ON prices BEGIN UPDATE catalog_version SET version = version + 1; END',
+        'CREATE TRIGGER IF NOT EXISTS prices_version_delete AFTER DELETE ON prices BEGIN UPDATE catalog_version SET version = version + 1; END',
+    ],
+    # 4: cached summaries of closed time buckets, reused by rolling summaries
+    [
+        'CREATE TABLE IF NOT EXISTS bucket_summaries (chat_id INTEGER NOT NULL, bucket INTEGER NOT NULL, summary TEXT NOT NULL, PRIMARY KEY (chat_id, bucket))',
+        'CREATE INDEX IF NOT EXISTS idx_bucket_summaries_bucket ON bucket_summaries (bucket)',
+    ],
+    # 5: drop the id indexes migration 2 used to build next to an INTEGER PRIMARY KEY
+    [
+        _id_index('chats'),
+        _id_index('users'),
+        _id_index('prices'),
+    ],
+]
+
+# Queries on the request path that must be served by an index, with sample parameters.
+# Message table queries are partitions.PARTITION_QUERIES
+HOT_QUERIES = [
+    ('SELECT bucket, summary FROM bucket_summaries WHERE chat_id = ? AND bucket >= ? AND bucket <= ?', (0, 0, 0)),
+    ('DELETE FROM bucket_summaries WHERE bucket < ?', (0,)),
+    ('SELECT summ, balance, interval, last, payed_date, active, tier FROM chats WHERE id = ?', (0,)),
+    ('UPDATE chats SET last = ?, summ = ? WHERE id = ?', (0, '', 0)),
+    ('UPDATE chats SET summ = ? WHERE id = ?', ('', 0)),
+    ('SELECT interval, balance, payed_date, active, tier FROM chats WHERE id = ?', (0,)),
+    ('SELECT balance, tier, payed_date FROM chats WHERE id = ?', (0,)),
+    ('SELECT paying, last, interval FROM users WHERE id = ?', (0,)),
+    ('UPDATE users SET last = ? WHERE id = ?', (0, 0)),
+]
+
+# Not matched by partitions.PARTITION_RE, so never taken for a real partition
+PLAN_CHECK_TABLE = 'messages_plan_check'
+
+
+def migrate(db=None, check=True):
+    """
+    Bring the database (default SQL_PATH) up to the latest schema version.
+
+    Returns:
+        The schema version after migrating
+    """
+    db = db if db is not None else get_db()
+
+    with db.connection() as conn:
+        # WAL lets readers proceed while the bot and cleaner write; the mode persists in the file
+        conn.execute('PRAGMA journal_mode=WAL')
+
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for target, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            log.info("Migrating database", version=target)
+            with conn:
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {target}')
+            version = target
+
+        if check:
+            check_query_plans(conn)
+
+        return version
+
+
+def check_query_plans(conn):
+    """Raise SchemaError if any hot query would fall back to a full table scan"""
+    regressions = []
+
+    def check(sql, params):
+        plan = conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+        scans = [row[3] for row in plan if row[3].startswith('SCAN')]
+        if scans:
+            regressions.append(f"{sql} -> {'; '.join(scans)}")
+
+    for sql, params in HOT_QUERIES:
+        check(sql, params)
+
+    # Partitions come and go, so check their queries on a throwaway one built from the same schema
+    conn.execute('SAVEPOINT plan_check')
+    try:
+        for statement in PARTITION_SCHEMA:
+            conn.execute(statement.format(table=PLAN_CHECK_TABLE))
+        for sql, params in PARTITION_QUERIES:
+            check(sql.format(table=LEGACY), params)
+            check(sql.format(table=PLAN_CHECK_TABLE), params)
+    finally:
+        conn.execute('ROLLBACK TO plan_check')
+        conn.execute('RELEASE plan_check')
+
+    if regressions:
+        raise SchemaError("Hot queries regressed to table scans:\n" + "\n".join(regressions))
@@ -0,0 +1,164 @@
+"""
+Streaming summary delivery.
+
+The worker appends text deltas from the LLM to a per-request Redis stream.
+The bot posts a placeholder message and a StreamRelay edits it as deltas
+arrive, throttled to stay inside Telegram's edit rate limits. Its calls go
+through the OutboundDispatcher, so they share the global and per-chat rate
+limits with every other message the bot sends. The final text
+still travels through the normal delivery queue, whose consumer replaces the
+placeholder with it.
+"""
+import threading
+import time
+import uuid
+
+import telebot
+
+from core.log import get_logger
+
+log = get_logger('stream')
+
+STREAM_TTL = 3600
+TELEGRAM_MAX_LENGTH = 4096
+
+PLACEHOLDER_TEXT = "⏳ Generating summary..."
+DELIVERED = 'delivered'
+
+
+def new_stream_key(gid):
+    return f'stream:{gid}:{uuid.uuid4().hex}'
+
+
+class SummaryStream:
+    def __init__(self, key, redis_conn, flush_interval=0.25):
+        self.key = key
+        self.redis_conn = redis_conn
+        self.flush_interval = flush_interval
+
+        self.buffer = []
+        self.flushed_at = time.monotonic()
+
+    # Producer side (worker)
+
+    def append(self, delta):
+        self.buffer.append(delta)
+        # Batch tiny token deltas into fewer stream entries
+        if time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self._add('delta', ''.join(self.buffer))
+            self.buffer = []
+        self.flushed_at = time.monotonic()
+
+    def finish(self):
+        self.flush()
+        self._add('done')
+
+    def fail(self, error):
+        self.flush()
+        self._add('error', error)
+
+    def _add(self, kind, text=''):
+        pipe = self.redis_conn.pipeline()
+        pipe.xadd(self.key, {'type': kind, 'text': text})
+        pipe.expire(self.key, STREAM_TTL)
+        pipe.execute()
+
+    # Consumer side (bot)
+
+    def read(self, last_id='0', timeout=5):
+        """
+        Block for up to `timeout` seconds for entries after `last_id`.
+
+        Returns:
+            List of (entry id, type, text)
+        """
+        result = self.redis_conn.xread({self.key: last_id}, block=max(int(timeout * 1000), 1))
+        if not result:
+            return []
+
+        return [(entry_id, fields[b'type'].decode(), fields[b'text'].decode()) for entry_id, fields in result[0][1]]
+
+    def claim_message(self, value):
+        """
+        Record which message shows this stream; only the first claim wins.
+
+        The relay claims with its placeholder message id, the delivery consumer
+        with DELIVERED when it got there first and sent a fresh message.
+        """
+        return bool(self.redis_conn.set(f'{self.key}:message', value, nx=True, ex=STREAM_TTL))
+
+    def claimed_message(self):
+        value = self.redis_conn.get(f'{self.key}:message')
+        return value.decode() if value is not None else None
+
+
+class StreamRelay:
+    """Shows a summary stream in a chat by progressively editing a placeholder message"""
+
+    def __init__(self, outbound, stream, chat_id, reply_to_message_id=None, edit_interval=2.0):
+        """
+        Args:
+            outbound: OutboundDispatcher that makes the Telegram calls
+        """
+        self.outbound = outbound
+        self.bot = outbound.bot
+        self.stream = stream
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.edit_interval = edit_interval
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name=f'relay-{self.chat_id}', daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self):
+        try:
+            self._relay()
+        except Exception as e:
+            log.warning("Relay failed", chat=self.chat_id, error=e)
+
+    def _relay(self):
+        placeholder = self.outbound.send(self.chat_id, self.bot.send_message, self.chat_id, PLACEHOLDER_TEXT, reply_to_message_id=self.reply_to_message_id)
+
+        if not self.stream.claim_message(placeholder.message_id):
+            # The summary was already delivered as a regular message
+            self.outbound.send(self.chat_id, self.bot.delete_message, self.chat_id, placeholder.message_id)
+            return
+
+        text, shown = '', ''
+        last_id = '0'
+        next_edit = time.monotonic()
+        deadline = time.monotonic() + STREAM_TTL
+
+        while time.monotonic() < deadline:
+            # Wake up no later than the next allowed edit if there is unshown text
+            timeout = max(next_edit - time.monotonic(), 0.05) if text != shown else 5
+            for entry_id, kind, chunk in self.stream.read(last_id, timeout):
+                last_id = entry_id
+                if kind == 'delta':
+                    text += chunk
+                elif kind == 'done':
+                    # The delivery consumer replaces the placeholder with the final text
+                    return
+                elif kind == 'error':
+                    self._edit(placeholder.message_id, "❌ Summary generation failed. Please try again later.")
+                    return
+
+            if text != shown and time.monotonic() >= next_edit:
+                next_edit = time.monotonic() + self._edit(placeholder.message_id, text[:TELEGRAM_MAX_LENGTH - 2] + " ▌")
+                shown = text
+
+    def _edit(self, message_id, text):
+        """Edit the placeholder, returning how long to wait before the next edit"""
+        try:
+            # Waits for the chat's rate limit and backs off on 429 replies
+            self.outbound.send(self.chat_id, self.bot.edit_message_text, text, self.chat_id, message_id)
+        except telebot.apihelper.ApiTelegramException as e:
+            if 'message is not modified' not in e.description:
+                raise
+        return self.edit_interval
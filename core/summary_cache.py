@@ -0,0 +1,76 @@
+"""
+Content-addressed cache of delivered summaries.
+
+A summary request is fingerprinted by its chat, the newest message id and
+message count in its window, and the prompt files in use. A repeated request
+over an unchanged window is answered from this cache without an LLM call.
+"""
+import collections
+import hashlib
+import os
+import threading
+
+from core.llm_gateway import PromptCache
+
+
+def fingerprint(gid, last_id, count, prompt_digest):
+    return hashlib.sha256(f"{gid}:{last_id}:{count}:{prompt_digest}".encode()).hexdigest()
+
+
+class SummaryCache:
+    def __init__(self, max_size=None):
+        self.max_size = int(max_size or os.getenv('SUMMARY_CACHE_SIZE', 512))
+
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        self.prompts = [PromptCache(path) for path in (os.getenv('PROMPT_PATH'), os.getenv('REDUCE_PROMPT_PATH')) if path]
+
+    def prompt_digest(self):
+        """Hash of the current prompt files, so editing a prompt invalidates cached summaries"""
+        digest = hashlib.sha256()
+        for prompt in self.prompts:
+            try:
+                digest.update(prompt.get().encode())
+            except OSError:
+                # The prompt lives with the worker; without it only the window is fingerprinted
+                pass
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            summary = self.entries.get(key)
+            if summary is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return summary
+
+    def put(self, key, summary):
+        with self.lock:
+            self.entries[key] = summary
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_summary_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SummaryCache()
+    return _cache
@@ -0,0 +1,150 @@
+"""
+Supervisor over several RQ worker processes.
+
+Each worker process runs its own SimpleWorker and LLM gateway, so up to
+WORKER_PROCESSES summaries are in flight at once. The supervisor restarts
+workers that die, reports each worker's state from its RQ registration, and
+on SIGTERM/SIGINT lets every worker finish its current job before exiting.
+"""
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+import dotenv
+import redis
+from rq import Worker
+
+from core.priority import WeightedWorker, queue_stats
+from core import metrics
+from core.log import get_logger
+
+dotenv.load_dotenv()
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', 1))
+HEALTH_INTERVAL = int(os.getenv('WORKER_HEALTH_INTERVAL', 60))
+SHUTDOWN_TIMEOUT = int(os.getenv('WORKER_SHUTDOWN_TIMEOUT', 120))
+# Restarts of one worker are spaced at least this far apart
+RESTART_DELAY = 5
+
+log = get_logger('supervisor')
+
+
+def run_worker(name, queues, metrics_port=0):
+    """Entry point of one worker process"""
+    from core.llm_gateway import get_gateway
+
+    metrics.serve(metrics_port)
+    gateway = get_gateway()
+    try:
+        worker = WeightedWorker(queues=queues, name=name, connection=redis.Redis(host=os.getenv('REDIS_HOST')))
+        worker.work()
+    finally:
+        gateway.close()
+
+
+class WorkerSupervisor:
+    def __init__(self, queues, processes=None):
+        self.queues = queues
+        self.processes = int(processes or WORKER_PROCESSES)
+        self.redis_conn = redis.Redis(host=os.getenv('REDIS_HOST'))
+
+        # Spawned, not forked: pooled SQLite and HTTP connections must not be shared
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = {}
+        self.restarts = {}
+        self.started = {}
+        self.names = {}
+        self.stop_signal = None
+
+    def worker_name(self, index):
+        # A crashed worker stays registered until its TTL runs out, so each restart gets a new name
+        return f"{socket.gethostname()}.{os.getpid()}.{index}.{self.restarts.get(index, 0)}"
+
+    def _start(self, index):
+        name = self.names[index] = self.worker_name(index)
+        # The supervisor serves METRICS_PORT, each worker the port after it plus its index
+        metrics_port = metrics.METRICS_PORT + 1 + index if metrics.METRICS_PORT else 0
+        process = self.context.Process(target=run_worker, args=(name, self.queues, metrics_port), name=f'worker-{index}', daemon=False)
+        process.start()
+        self.workers[index] = process
+        self.started[index] = time.monotonic()
+        log.info("Started worker", worker=name, pid=process.pid)
+
+    def health(self):
+        """Per-worker status: process liveness plus state and counters from RQ's registry"""
+        report = []
+        for index, process in sorted(self.workers.items()):
+            name = self.names[index]
+            entry = {'name': name, 'pid': process.pid, 'alive': process.is_alive(), 'restarts': self.restarts.get(index, 0)}
+            try:
+                worker = Worker.find_by_key(Worker.redis_worker_namespace_prefix + name, connection=self.redis_conn)
+            except redis.RedisError:
+                worker = None
+            if worker is not None:
+                entry.update(
+                    state=worker.state,
+                    job=worker.get_current_job_id(),
+                    successful=worker.successful_job_count,
+                    failed=worker.failed_job_count,
+                    heartbeat=worker.last_heartbeat.isoformat() if worker.last_heartbeat else None,
+                )
+            report.append(entry)
+        return report
+
+    def _report(self):
+        for entry in self.health():
+            log.info("Worker health", worker=entry['name'], alive=entry['alive'], state=entry.get('state'), job=entry.get('job'),
+                     ok=entry.get('successful'), failed=entry.get('failed'), restarts=entry['restarts'])
+
+    def _stop(self, signum, frame):
+        self.stop_signal = signum
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        metrics.gauge('worker_alive', 'Whether each worker process is running', lambda: {(str(index),): int(process.is_alive()) for index, process in self.workers.items()}, ['worker'])
+        metrics.gauge('worker_restarts', 'Restarts of each worker process', lambda: {(str(index),): self.restarts.get(index, 0) for index in self.workers}, ['worker'])
+        metrics.gauge('rq_queue_depth', 'Jobs waiting in each queue', lambda: {(name,): stats['depth'] for name, stats in queue_stats(self.redis_conn, self.queues).items()}, ['queue'])
+        metrics.serve()
+
+        for index in range(self.processes):
+            self._start(index)
+
+        last_report = time.monotonic()
+        while self.stop_signal is None:
+            time.sleep(1)
+
+            for index, process in list(self.workers.items()):
+                if process.is_alive() or self.stop_signal is not None:
+                    continue
+                if time.monotonic() - self.started[index] < RESTART_DELAY:
+                    continue
+                log.error("Worker exited, restarting", worker=self.names[index], code=process.exitcode)
+                self.restarts[index] = self.restarts.get(index, 0) + 1
+                self._start(index)
+
+            if time.monotonic() - last_report >= HEALTH_INTERVAL:
+                self._report()
+                last_report = time.monotonic()
+
+        self.shutdown()
+
+    def shutdown(self):
+        """Warm shutdown: workers finish their current job, stragglers are killed after SHUTDOWN_TIMEOUT"""
+        log.info("Stopping workers", workers=len(self.workers))
+        # Ctrl-C already reached the workers through the process group; a second signal would force-stop them
+        if self.stop_signal != signal.SIGINT:
+            for process in self.workers.values():
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for process in self.workers.values():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                log.warning("Worker did not stop in time, killing it", pid=process.pid)
+                process.kill()
+                process.join()
+        log.info("All workers stopped")
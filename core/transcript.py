@@ -0,0 +1,140 @@
+"""
+Compact, token-budgeted transcripts for the summary prompt.
+
+The model gets the same conversation in fewer tokens:
+  - authors get short aliases (A, B, ... AA) listed once in a legend
+  - consecutive messages from one author are merged into a single line
+  - replies are marked with the alias of the author being answered
+  - noise (emoji-only messages, one-word acks, repeats) is dropped and
+    overly long messages are trimmed
+  - when the transcript is over budget the oldest lines are dropped, so the
+    most recent messages always survive
+"""
+import os
+import re
+import string
+
+import dotenv
+
+from core.chunking import estimate_tokens
+
+dotenv.load_dotenv()
+# Budget for the whole transcript; longer windows keep only the newest messages
+MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', 100000))
+MAX_MESSAGE_CHARS = int(os.getenv('SUMMARY_MAX_MESSAGE_CHARS', 1500))
+# Merged lines stay short enough to land whole in one map-reduce chunk
+MAX_LINE_CHARS = 2 * MAX_MESSAGE_CHARS
+
+ACKS = {
+    'ok', 'okay', 'k', 'kk', 'yes', 'yep', 'yeah', 'no', 'nope', 'lol', 'lmao', 'haha', 'hah', 'thx', 'thanks',
+    'ty', 'np', 'sure', 'right', 'true', 'agreed', '+', '+1', '-', 'ок', 'ага', 'да', 'нет', 'спасибо', 'пасиб',
+    'лол', 'ахах', 'хах', 'понял', 'ясно', 'норм', 'угу',
+}
+
+WHITESPACE_RE = re.compile(r'\s+')
+PUNCTUATION = string.punctuation + '…«»“”'
+
+
+def alias(index):
+    """A, B, ... Z, AA, AB, ..."""
+    name = ''
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        name = chr(ord('A') + rest) + name
+    return name
+
+
+def _normalize(text):
+    return WHITESPACE_RE.sub(' ', text).strip()
+
+
+def is_noise(text):
+    """Messages that carry nothing worth summarizing"""
+    bare = text.strip(PUNCTUATION + ' ').lower()
+    if not bare or bare in ACKS:
+        return True
+    # Emoji, reactions and other symbol-only messages
+    return not any(c.isalnum() for c in bare)
+
+
+def _trim(text):
+    if len(text) <= MAX_MESSAGE_CHARS:
+        return text
+    return text[:MAX_MESSAGE_CHARS].rsplit(' ', 1)[0] + '…'
+
+
+def build(rows, max_tokens=None):
+    """
+    Build the compact transcript of a window.
+
+    Args:
+        rows: (time, user, text, id, reply) message rows, oldest first;
+            rows with only (time, user, text) are accepted as well
+
+    Returns:
+        (legend, lines): the legend line naming each alias (empty if there
+        are no messages) and the transcript lines, oldest first
+    """
+    max_tokens = max_tokens or MAX_TOKENS
+
+    # Keep messages that carry content, skipping repeats of the same text
+    messages, seen = [], set()
+    for row in rows:
+        text = _normalize(row[2] or '')
+        key = (row[1], text.lower())
+        if is_noise(text) or key in seen:
+            continue
+        seen.add(key)
+        messages.append((row[1], _trim(text), row[3] if len(row) > 3 else None, row[4] if len(row) > 4 else 0))
+
+    authors = {}
+    by_id = {mid: user for user, _, mid, _ in messages if mid is not None}
+    for user, _, _, _ in messages:
+        authors.setdefault(user, alias(len(authors)))
+
+    # One line per run of consecutive messages by the same author; a reply starts a new line
+    runs, run_chars = [], 0
+    for user, text, _, reply in messages:
+        target = authors.get(by_id.get(reply)) if reply else None
+        if target == authors[user]:
+            # Answering oneself is just a continuation
+            target = None
+        if runs and runs[-1][0] == user and target is None and run_chars + len(text) <= MAX_LINE_CHARS:
+            runs[-1][2].append(text)
+            run_chars += len(text) + 3
+            continue
+        runs.append((user, target, [text]))
+        run_chars = len(text)
+
+    lines = []
+    for user, target, texts in runs:
+        prefix = f'{authors[user]}>{target}' if target else authors[user]
+        lines.append(f"{prefix}: {' | '.join(texts)}")
+
+    # Newest lines first until the budget is spent
+    kept, used = [], 0
+    for line in reversed(lines):
+        tokens = estimate_tokens(line)
+        if kept and used + tokens > max_tokens:
+            break
+        kept.append(line)
+        used += tokens
+    kept.reverse()
+
+    if len(kept) < len(lines):
+        kept.insert(0, f'[{len(lines) - len(kept)} earlier lines omitted]')
+
+    # Only name the authors that are still in the transcript
+    present = set()
+    for line in kept:
+        if not line.startswith('['):
+            present.update(line.split(':', 1)[0].split('>'))
+    legend = ', '.join(f'{a}={user}' for user, a in authors.items() if a in present)
+    return (f'Participants (refer to them by name): {legend}' if legend else ''), kept
+
+
+def format_rows(rows, max_tokens=None):
+    """The compact transcript as one string"""
+    legend, lines = build(rows, max_tokens)
+    return '\n'.join([legend] + lines if legend else lines)
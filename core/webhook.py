@@ -0,0 +1,113 @@
+"""
+Webhook ingestion: a small local HTTP receiver for Telegram updates.
+
+Telegram (or a reverse proxy in front of this server) POSTs each update as
+JSON. Requests are checked against the secret token given to setWebhook and
+handed to the same ChatDispatcher the async runtime uses, so handlers behave
+identically in polling and webhook mode.
+
+For local testing, post a recorded update:
+    curl -H 'X-Telegram-Bot-Api-Secret-Token: <secret>' --data @update.json http://127.0.0.1:8443/webhook
+"""
+import asyncio
+import hmac
+import http.server
+import json
+import threading
+
+import telebot
+
+from core.runtime import ChatDispatcher
+from core.log import get_logger
+
+log = get_logger('webhook')
+
+MAX_BODY = 1024 * 1024
+
+
+class WebhookServer:
+    def __init__(self, dispatcher, secret_token, host='127.0.0.1', port=8443, path='/webhook'):
+        self.dispatcher = dispatcher
+        self.secret_token = secret_token
+        self.path = path
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.send_response(server.receive(self.path, self.headers, self.rfile))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                # Telegram posts every update; only failures are worth a line
+                pass
+
+        return Handler
+
+    def receive(self, path, headers, body):
+        """Validate and queue one update. Returns the HTTP status to answer with"""
+        if path != self.path:
+            return 404
+
+        token = headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            log.warning("Rejected update with invalid secret token")
+            return 403
+
+        length = int(headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            return 413
+
+        try:
+            update = telebot.types.Update.de_json(json.loads(body.read(length)))
+        except (ValueError, TypeError, KeyError) as e:
+            log.warning("Malformed update", error=e)
+            return 400
+
+        # Telegram retries non-2xx responses, so a full queue just delays the update
+        if not self.dispatcher.submit(update):
+            return 503
+
+        return 200
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='webhook', daemon=True)
+        self.thread.start()
+        host, port = self.httpd.server_address[:2]
+        log.info(f"Listening on http://{host}:{port}{self.path}")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def run_webhook(bot, secret_token, host, port, path='/webhook', public_url=None):
+    """
+    Serve updates posted to the local receiver until interrupted.
+    If `public_url` is set, it is registered with Telegram via setWebhook.
+    """
+    async def main():
+        dispatcher = ChatDispatcher(lambda update: bot.process_new_updates([update]))
+        dispatcher.start()
+
+        server = WebhookServer(dispatcher, secret_token, host, port, path)
+        server.start()
+
+        if public_url:
+            bot.set_webhook(url=public_url, secret_token=secret_token)
+            log.info("Registered webhook", url=public_url)
+
+        try:
+            await asyncio.Event().wait()
+        finally:
+            server.stop()
+            await dispatcher.join()
+            dispatcher.close()
+
+    asyncio.run(main())